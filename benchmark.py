@@ -0,0 +1,530 @@
+"""Gateway load test.
+
+Opens N simulated /ws clients, has them identify and answer heartbeats, then has
+some of them post messages and measures how long each one takes to reach every
+other client in the server.
+
+    python benchmark.py --clients 10000 --senders 50 --rate 2 --duration 30
+    python benchmark.py --url http://localhost:5000 --pid 1234 --clients 20000
+    python benchmark.py --encoding msgpack --compress --batch
+    python benchmark.py --keys 100000
+
+
+Without --url the app is started in this process (it still needs the database
+from config.py), with --url it runs against a server that is already up.
+--keys skips the gateway and times cached User.from_prisma calls instead.
+"""
+import argparse
+import asyncio
+import http.client
+import json
+import time
+import tracemalloc
+import zlib
+from hashlib import sha512
+from contextlib import AsyncExitStack
+from typing import Any, Optional
+from urllib.parse import urlparse
+
+import msgpack
+from quart.testing.connections import WebsocketDisconnectError
+from wsproto import ConnectionType, WSConnection
+from wsproto.events import (
+    AcceptConnection,
+    BytesMessage,
+    CloseConnection,
+    Message,
+    Ping,
+    RejectConnection,
+    Request,
+    TextMessage,
+)
+
+PASSWORD = "benchmark"
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    if len(values) == 0:
+        return 0
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def rss(pid: int) -> int:
+    with open(f"/proc/{pid}/status") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+class InProcess:
+    """The app from main.py driven through Quart's test client."""
+
+    def __init__(self):
+        import main
+
+        self.app = main.app
+        self.stack = AsyncExitStack()
+
+    async def start(self):
+        await self.stack.enter_async_context(self.app.test_app())
+        self.client = self.app.test_client()
+
+    async def stop(self):
+        await self.stack.aclose()
+
+    async def rest(
+        self, method: str, path: str, data: Optional[dict] = None, token: str = None
+    ) -> tuple[int, Any]:
+        response = await self.client.open(
+            path,
+            method=method,
+            json=data,
+            headers={"x-token": token} if token is not None else {},
+        )
+        return response.status_code, await response.get_json()
+
+    def websocket(self):
+        return self.client.websocket("/ws")
+
+    def memory(self) -> int:
+        # server and clients share the process, so this covers both sides
+        return tracemalloc.get_traced_memory()[0]
+
+
+class Localhost:
+    """A server that is already running, REST over http.client and /ws over wsproto."""
+
+    def __init__(self, url: str, pid: Optional[int]):
+        url = urlparse(url)
+        self.host = url.hostname
+        self.port = url.port or 80
+        self.pid = pid
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    def _rest(self, method: str, path: str, data: Optional[dict], token: str):
+        connection = http.client.HTTPConnection(self.host, self.port)
+        headers = {"content-type": "application/json"}
+        if token is not None:
+            headers["x-token"] = token
+        connection.request(
+            method,
+            path,
+            body=None if data is None else json.dumps(data),
+            headers=headers,
+        )
+        response = connection.getresponse()
+        body = response.read()
+        connection.close()
+        return response.status, json.loads(body) if body else None
+
+    async def rest(
+        self, method: str, path: str, data: Optional[dict] = None, token: str = None
+    ) -> tuple[int, Any]:
+        return await asyncio.to_thread(self._rest, method, path, data, token)
+
+    def websocket(self):
+        return WebSocket(self.host, self.port, "/ws")
+
+    def memory(self) -> int:
+        return 0 if self.pid is None else rss(self.pid)
+
+
+class WebSocket:
+    def __init__(self, host: str, port: int, path: str):
+        self.host = host
+        self.port = port
+        self.path = path
+        self.connection = WSConnection(ConnectionType.CLIENT)
+        self.messages: list[str | bytes] = []
+        self.partial: list[str | bytes] = []
+
+    async def __aenter__(self) -> "WebSocket":
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        self.writer.write(
+            self.connection.send(Request(host=self.host, target=self.path))
+        )
+        while True:
+            self.connection.receive_data(await self.reader.read(65536))
+            for event in self.connection.events():
+                if isinstance(event, AcceptConnection):
+                    return self
+                if isinstance(event, RejectConnection):
+                    raise ConnectionError("websocket rejected")
+
+    async def __aexit__(self, *args):
+        self.writer.close()
+
+    async def send(self, data: str | bytes):
+        self.writer.write(self.connection.send(Message(data=data)))
+
+    async def receive(self) -> str | bytes:
+        while len(self.messages) == 0:
+            data = await self.reader.read(65536)
+            if not data:
+                raise ConnectionError("websocket closed")
+            self.connection.receive_data(data)
+            for event in self.connection.events():
+                if isinstance(event, (TextMessage, BytesMessage)):
+                    self.partial.append(event.data)
+                    if event.message_finished:
+                        empty = "" if isinstance(event, TextMessage) else b""
+                        self.messages.append(empty.join(self.partial))
+                        self.partial = []
+                elif isinstance(event, Ping):
+                    self.writer.write(self.connection.send(event.response()))
+                elif isinstance(event, CloseConnection):
+                    raise ConnectionError(f"websocket closed {event.code}")
+        return self.messages.pop(0)
+
+
+class Benchmark:
+    def __init__(self, transport, options: argparse.Namespace):
+        self.transport = transport
+        self.options = options
+        self.latencies: list[float] = []
+        self.lags: list[float] = []
+        self.events = 0
+        self.bytes = 0
+        self.sent = 0
+        self.failed = 0
+        # sockets the server closed (evicted, reaped) and clients that broke
+        self.dropped = 0
+        self.closed = 0
+        self.running = True
+
+    async def setup(self) -> tuple[list[str], str]:
+        # reuses the bench accounts from earlier runs, only the server is new
+        tokens = []
+        for i in range(self.options.users):
+            email = f"bench{i}@bench.test"
+            await self.transport.rest(
+                "PUT",
+                "/api/auth/register/",
+                {"username": f"bench{i}", "password": PASSWORD, "email": email},
+            )
+            status, session = await self.transport.rest(
+                "PUT",
+                "/api/auth/session/",
+                {"session_name": "benchmark", "email": email, "password": PASSWORD},
+            )
+            if status != 201:
+                raise RuntimeError(f"could not log in {email}: {session}")
+            tokens.append(session["token"])
+        _, server = await self.transport.rest(
+            "PUT", "/api/server/", {"name": "benchmark"}, tokens[0]
+        )
+        self.server = server["snowflake"]
+        _, channel = await self.transport.rest(
+            "PUT", f"/api/channel/{self.server}/", {"name": "benchmark"}, tokens[0]
+        )
+        for token in tokens[1:]:
+            _, invite = await self.transport.rest(
+                "PUT", f"/api/server/{self.server}/invite", None, tokens[0]
+            )
+            await self.transport.rest(
+                "PATCH", "/api/server/join", {"invite": invite["invite"]}, token
+            )
+        return tokens, channel["snowflake"]
+
+    async def teardown(self, tokens: list[str]):
+        await self.transport.rest(
+            "DELETE", f"/api/server/{self.server}/", None, tokens[0]
+        )
+
+    async def client(self, websocket, token: str, ready: asyncio.Event):
+        identify = {"token": token, "batch": self.options.batch}
+        if self.options.compress:
+            identify["compress"] = "zlib-stream"
+        if self.options.encoding == "msgpack":
+            identify["encoding"] = "msgpack"
+        await websocket.send(json.dumps({"code": 2, "data": identify}))
+        # one stream per connection, every frame ends on a sync flush
+        inflate = zlib.decompressobj()
+        try:
+            while self.running:
+                frame = await websocket.receive()
+                # what went over the wire, before inflating
+                self.bytes += len(frame)
+                events = self.decode(frame, inflate)
+                for event in events if isinstance(events, list) else [events]:
+                    self.events += 1
+                    match event["code"]:
+                        case 1:
+                            await websocket.send('{"code": 1}')
+                        case 2:
+                            ready.set()
+                        case 100 if "id" not in event:
+                            # replies to a gateway sender also carry code 100
+                            sent = float(event["data"]["content"].split()[1])
+                            self.latencies.append(time.time() - sent)
+        except asyncio.CancelledError:
+            pass
+        except (ConnectionError, WebsocketDisconnectError):
+            # how each transport reports the server closing the socket
+            self.dropped += 1
+        except Exception:
+            self.closed += 1
+
+    def decode(self, frame: str | bytes, inflate) -> Any:
+        # text frames are plain json, including anything sent before identify
+        if isinstance(frame, str):
+            return json.loads(frame)
+        if self.options.compress:
+            frame = inflate.decompress(frame)
+        if self.options.encoding == "msgpack":
+            return msgpack.unpackb(frame)
+        return json.loads(frame)
+
+    async def sender(self, token: str, channel: str, websocket=None):
+        interval = 1 / self.options.rate
+        deadline = time.time() + self.options.duration
+        id = 0
+        while time.time() < deadline:
+            content = f"bench {time.time()}"
+            if websocket is not None:
+                id += 1
+                await websocket.send(
+                    json.dumps(
+                        {
+                            "code": 100,
+                            "id": id,
+                            "data": {"channel_snowflake": channel, "content": content},
+                        }
+                    )
+                )
+                self.sent += 1
+            else:
+                status, _ = await self.transport.rest(
+                    "PUT", f"/api/message/{channel}/", {"content": content}, token
+                )
+                if status == 201:
+                    self.sent += 1
+                else:
+                    self.failed += 1
+            await asyncio.sleep(interval)
+
+    async def lag(self):
+        # how late the loop wakes up a sleeper, in process that is the server loop
+        loop = asyncio.get_running_loop()
+        while self.running:
+            before = loop.time()
+            await asyncio.sleep(0.1)
+            self.lags.append(loop.time() - before - 0.1)
+
+    async def run(self):
+        await self.transport.start()
+        tokens, channel = await self.setup()
+        print(f"setup done, {len(tokens)} users in server {self.server}")
+
+        async with AsyncExitStack() as stack:
+            if self.options.url is None:
+                tracemalloc.start()
+            before = self.transport.memory()
+            websockets = []
+            clients = []
+            readies = []
+            limit = asyncio.Semaphore(self.options.concurrency)
+            started = time.time()
+
+            async def connect(i: int):
+                async with limit:
+                    websocket = await stack.enter_async_context(
+                        self.transport.websocket()
+                    )
+                    ready = asyncio.Event()
+                    websockets.append(websocket)
+                    readies.append(ready)
+                    clients.append(
+                        asyncio.create_task(
+                            self.client(websocket, tokens[i % len(tokens)], ready)
+                        )
+                    )
+                    await ready.wait()
+
+            await asyncio.gather(*(connect(i) for i in range(self.options.clients)))
+            connected = time.time() - started
+            memory = self.transport.memory() - before
+            if self.options.url is None:
+                tracemalloc.stop()
+            print(f"{self.options.clients} clients identified in {connected:.2f}s")
+
+            lag = asyncio.create_task(self.lag())
+            self.events = 0
+            self.bytes = 0
+            started = time.time()
+            senders = [
+                self.sender(
+                    tokens[i % len(tokens)],
+                    channel,
+                    websockets[i] if self.options.via == "gateway" else None,
+                )
+                for i in range(self.options.senders)
+            ]
+            await asyncio.gather(*senders)
+            # let the last events land
+            await asyncio.sleep(1)
+            elapsed = time.time() - started
+            self.running = False
+            lag.cancel()
+            for client in clients:
+                client.cancel()
+            _, gateway = await self.transport.rest("GET", "/api/gateway")
+
+        await self.teardown(tokens)
+        await self.transport.stop()
+        self.report(connected, elapsed, memory, gateway)
+
+    def report(self, connected: float, elapsed: float, memory: int, gateway: Any):
+        latencies = sorted(self.latencies)
+        lags = sorted(self.lags)
+        expected = self.sent * self.options.clients
+        print(
+            json.dumps(
+                {
+                    "clients": self.options.clients,
+                    "mode": {
+                        "encoding": self.options.encoding,
+                        "compress": self.options.compress,
+                        "batch": self.options.batch,
+                    },
+                    "identify_seconds": connected,
+                    "messages": {"sent": self.sent, "failed": self.failed},
+                    "fanout": {
+                        "delivered": len(latencies),
+                        "expected": expected,
+                        "p50_ms": percentile(latencies, 0.5) * 1000,
+                        "p90_ms": percentile(latencies, 0.9) * 1000,
+                        "p99_ms": percentile(latencies, 0.99) * 1000,
+                        "max_ms": (latencies[-1] if latencies else 0) * 1000,
+                    },
+                    "events_per_second": self.events / elapsed,
+                    "bytes_per_event": self.bytes / self.events if self.events else 0,
+                    "memory_per_connection": memory / self.options.clients
+                    if memory
+                    else None,
+                    "loop_lag": {
+                        "p50_ms": percentile(lags, 0.5) * 1000,
+                        "p99_ms": percentile(lags, 0.99) * 1000,
+                        "max_ms": (lags[-1] if lags else 0) * 1000,
+                    },
+                    "server_closes": self.dropped,
+                    "client_errors": self.closed,
+                    "gateway": gateway,
+                },
+                indent=2,
+            )
+        )
+
+
+def legacy_key(args: tuple, kwargs: dict) -> str:
+    # how sync_cache keyed calls before cache_key, kept to compare against
+    strings = []
+    for arg in list(args) + list(kwargs.values()):
+        try:
+            strings.append(str(arg.snowflake))
+        except:
+            try:
+                strings.append(str(arg.token))
+            except:
+                strings.append(str(arg))
+    strings.sort()
+    return sha512(("sync" + "".join(strings)).encode("utf-8")).hexdigest()
+
+
+async def keys(iterations: int):
+    """Cache hits on User.from_prisma with the old and the new key builder."""
+    from prisma import Base64, models
+    from quart import Quart
+
+    # primitive first, it and utils import each other and only work in this order
+    from common.primitive import User
+    import common.utils
+    from common.cache import Cache
+
+    users = [
+        models.User.construct(
+            snowflake=1000 + i,
+            name=f"bench{i}",
+            email=f"bench{i}@bench.test",
+            picture=Base64.encode(b"picture"),
+            friends=[],
+            inServers=[],
+        )
+        for i in range(100)
+    ]
+    app = Quart("benchmark")
+    results = {}
+    async with app.app_context():
+        for name, builder in (
+            ("sha512", legacy_key),
+            ("tuple", common.utils.cache_key),
+        ):
+            common.utils.cache_key = builder
+            app.cache = Cache()
+            key = [builder((user,), {"level": 1}) for user in users]
+            started = time.perf_counter()
+            for i in range(iterations):
+                builder((users[i % 100],), {"level": 1})
+            built = time.perf_counter() - started
+            for user in users:
+                User.from_prisma(user, level=1)
+            started = time.perf_counter()
+            for i in range(iterations):
+                User.from_prisma(users[i % 100], level=1)
+            called = time.perf_counter() - started
+            assert len(set(key)) == len(users)
+            results[name] = {
+                "key_us": built / iterations * 1e6,
+                "from_prisma_hit_us": called / iterations * 1e6,
+                "hits": app.cache.namespace("User.from_prisma").hits,
+            }
+    results["speedup"] = {
+        "key": results["sha512"]["key_us"] / results["tuple"]["key_us"],
+        "from_prisma_hit": results["sha512"]["from_prisma_hit_us"]
+        / results["tuple"]["from_prisma_hit_us"],
+    }
+    print(json.dumps(results, indent=2))
+
+
+def arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Gateway load test")
+    parser.add_argument("--url", help="run against this server instead of in process")
+    parser.add_argument("--pid", type=int, help="server pid, for memory with --url")
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--senders", type=int, default=10)
+    parser.add_argument("--rate", type=float, default=1, help="messages/s per sender")
+    parser.add_argument("--duration", type=float, default=10, help="seconds")
+    parser.add_argument("--via", choices=["rest", "gateway"], default="rest")
+    parser.add_argument("--batch", action="store_true")
+    parser.add_argument(
+        "--compress", action="store_true", help="identify with zlib-stream"
+    )
+    parser.add_argument(
+        "--keys", type=int, metavar="ITERATIONS", help="time cache keys instead"
+    )
+    parser.add_argument("--encoding", choices=["json", "msgpack"], default="json")
+    parser.add_argument(
+        "--concurrency", type=int, default=200, help="parallel connects"
+    )
+    options = parser.parse_args()
+    options.users = min(options.users, options.clients)
+    options.senders = min(options.senders, options.clients)
+    return options
+
+
+if __name__ == "__main__":
+    options = arguments()
+    if options.keys is not None:
+        asyncio.run(keys(options.keys))
+        raise SystemExit
+    transport = (
+        InProcess() if options.url is None else Localhost(options.url, options.pid)
+    )
+    asyncio.run(Benchmark(transport, options).run())
@@ -89,9 +89,33 @@ async def auth_session(data: Create.Session) -> Session:
 async def auth_session_delete(session: Session) -> Response.Success:
     """Delete a session."""
     await app.db.session_set(token=session.token)
+    app.ws.revoke(session.user.snowflake, session.token)
     return Response.Success(response="Successfully invalidated session.")
 
 
+# DELETE /account (delete the account, every session is logged out)
+#     200 OK - Account deleted - returns nothing
+#     401 Unauthorized - Token invalid or password incorrect
+#     500 Internal Server Error
+
+
+@bp.delete("/account/")
+@tag(["Auth", "Delete", "User"])
+@benchmark()
+@auth()
+@validate_request(Option.Password)
+@validate_response(Response.Success, 200)
+async def auth_account_delete(
+    session: Session, data: Option.Password
+) -> Response.Success:
+    """Delete the account the session belongs to."""
+    await app.db.user_set(
+        snowflake=session.user.snowflake, password=data.password, delete=True
+    )
+    app.ws.revoke(session.user.snowflake)
+    return Response.Success(response="Dont let the door hit you on the way out")
+
+
 # GET /session (list all)
 #     200 OK - Returns list of all sessions
 #     401 Unauthorized - Token invalid
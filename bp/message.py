@@ -2,8 +2,17 @@ import asyncio
 from quart import Blueprint
 from quart import current_app as app
 from quart_schema import tag, validate_request, validate_response, validate_querystring
-from common.primitive import Channel, Create, List, Message, Option, Response, Session
-from common.utils import auth, benchmark, send_to_websocket
+from common.primitive import (
+    Channel,
+    Create,
+    Error,
+    List,
+    Message,
+    Option,
+    Response,
+    Session,
+)
+from common.utils import auth, benchmark, send_to_server, websocket
 
 bp = Blueprint("message", __name__)
 
@@ -67,25 +76,7 @@ async def message_create(
     session: Session, channel_snowflake: str, data: Create.Message
 ) -> Message:
     """Create a message in a channel."""
-    channel: Channel = await app.db.channel_get(
-        channel_snowflake=channel_snowflake, user=session.user, includeserver=True
-    )
-    try:
-        members = [x.snowflake for x in channel.server.members]
-    except:
-        channel: Channel = await app.db.channel_get(
-            channel_snowflake=channel_snowflake, user=session.user, includeserver=True
-        )
-        members = [x.snowflake for x in channel.server.members]
-    message = await app.db.message_set(
-        channel=channel,
-        user=session.user,
-        content=data.content,
-    )
-    asyncio.create_task(
-        send_to_websocket(members, {"code": 100, "data": message.dict()})
-    )
-    return message
+    return await create_message(session, channel_snowflake, data.content)
 
 
 # DELETE /<server_snowflake>/<channel_snowflake>/<message_snowflake>/ (delete message if user is owner or message author)
@@ -103,31 +94,7 @@ async def message_delete(
     session: Session, channel_snowflake: str, message_snowflake: str
 ) -> Response.Success:
     """Delete a message in a channel."""
-    channel: Channel = await app.db.channel_get(
-        channel_snowflake=channel_snowflake, user=session.user, includeserver=True
-    )
-    try:
-        members = [x.snowflake for x in channel.server.members]
-    except:
-        channel: Channel = await app.db.channel_get(
-            channel_snowflake=channel_snowflake, user=session.user, includeserver=True
-        )
-        members = [x.snowflake for x in channel.server.members]
-    await app.db.message_set(
-        channel=channel,
-        snowflake=message_snowflake,
-        user=session.user,
-        delete=True,
-    )
-    asyncio.create_task(
-        send_to_websocket(
-            members,
-            {
-                "code": 300,
-                "data": {"snowflake": message_snowflake, "channel": channel.dict()},
-            },
-        )
-    )
+    await delete_message(session, channel_snowflake, message_snowflake)
     return Response.Success(response="Message deleted")
 
 
@@ -144,24 +111,128 @@ async def message_update(
     data: Create.Message,
 ) -> Message:
     """Update a message in a channel."""
-    channel: Channel = await app.db.channel_get(
-        channel_snowflake=channel_snowflake, user=session.user, includeserver=True
+    return await update_message(
+        session, channel_snowflake, message_snowflake, data.content
     )
-    try:
-        members = [x.snowflake for x in channel.server.members]
-    except:
+
+
+# the same three over the gateway, authed by the session the socket identified
+# with, replies are the event data and carry the request id back
+#     100 {"channel_snowflake": str, "content": str} - returns message object
+#     200 {"channel_snowflake": str, "message_snowflake": str, "content": str} - returns message object
+#     300 {"channel_snowflake": str, "message_snowflake": str} - returns {"snowflake": str}
+
+
+@websocket(100, {"channel_snowflake": str, "content": str})
+async def message_create_ws(
+    session: Session, channel_snowflake: str, content: str
+) -> dict:
+    return (
+        await create_message(
+            session,
+            channel_snowflake,
+            Create.Message(content=content).content,
+            gateway=True,
+        )
+    ).dict()
+
+
+@websocket(200, {"channel_snowflake": str, "message_snowflake": str, "content": str})
+async def message_update_ws(
+    session: Session, channel_snowflake: str, message_snowflake: str, content: str
+) -> dict:
+    return (
+        await update_message(
+            session,
+            channel_snowflake,
+            message_snowflake,
+            Create.Message(content=content).content,
+        )
+    ).dict()
+
+
+@websocket(300, {"channel_snowflake": str, "message_snowflake": str})
+async def message_delete_ws(
+    session: Session, channel_snowflake: str, message_snowflake: str
+) -> dict:
+    await delete_message(session, channel_snowflake, message_snowflake)
+    return {"snowflake": message_snowflake}
+
+
+async def create_message(
+    session: Session, channel_snowflake: str, content: str, gateway: bool = False
+) -> Message:
+    if gateway:
+        # the gateway already indexes the socket's servers, so with the channel
+        # cached the insert is the only query
+        channel: Channel = await app.db.channel_find(
+            channel_snowflake=channel_snowflake
+        )
+        if channel.server.snowflake not in app.ws.memberships.get(
+            str(session.user.snowflake), ()
+        ):
+            raise Error("Channel not found", 404)
+    else:
         channel: Channel = await app.db.channel_get(
             channel_snowflake=channel_snowflake, user=session.user, includeserver=True
         )
-        members = [x.snowflake for x in channel.server.members]
     message = await app.db.message_set(
         channel=channel,
-        snowflake=message_snowflake,
         user=session.user,
-        content=data.content,
+        content=content,
+        member=gateway,
     )
+    asyncio.create_task(
+        send_to_server(
+            channel.server.snowflake,
+            {"code": 100, "data": message.dict()},
+            channel.snowflake,
+        )
+    )
+    return message
 
+
+async def update_message(
+    session: Session, channel_snowflake: str, message_snowflake: str, content: str
+) -> Message:
+    channel: Channel = await app.db.channel_get(
+        channel_snowflake=channel_snowflake, user=session.user, includeserver=True
+    )
+    message = await app.db.message_set(
+        channel=channel,
+        snowflake=message_snowflake,
+        user=session.user,
+        content=content,
+    )
     asyncio.create_task(
-        send_to_websocket(members, {"code": 200, "data": message.dict()})
+        send_to_server(
+            channel.server.snowflake,
+            {"code": 200, "data": message.dict()},
+            channel.snowflake,
+        )
     )
     return message
+
+
+async def delete_message(
+    session: Session, channel_snowflake: str, message_snowflake: str
+):
+    channel: Channel = await app.db.channel_get(
+        channel_snowflake=channel_snowflake, user=session.user, includeserver=True
+    )
+    await app.db.message_set(
+        channel=channel,
+        snowflake=message_snowflake,
+        user=session.user,
+        delete=True,
+    )
+    asyncio.create_task(
+        send_to_server(
+            channel.server.snowflake,
+            {
+                "code": 300,
+                "data": {"snowflake": message_snowflake, "channel": channel.dict()},
+            },
+            channel.snowflake,
+        )
+    )
@@ -4,8 +4,19 @@ import zlib
 import bcrypt
 from quart import Blueprint, render_template
 from quart import current_app as app
-from quart_schema import tag, validate_request, validate_response
-from common.primitive import Create, Invite, Join, List, Response, Server, Session
+from quart_schema import tag, validate_querystring, validate_request, validate_response
+from common.primitive import (
+    Create,
+    Error,
+    Invite,
+    Join,
+    List,
+    Option,
+    Presence,
+    Response,
+    Server,
+    Session,
+)
 from common.utils import auth, benchmark, validate_string, websocket
 
 bp = Blueprint("server", __name__)
@@ -62,10 +73,12 @@ async def server_info(session: Session, server_snowflake: str) -> Server:
 @validate_response(Server, 201)
 async def server_create(session: Session, data: Create.Server) -> Server:
     """Create server."""
-    return await app.db.server_set(
+    server = await app.db.server_set(
         name=data.name,
         user=session.user,
     )
+    app.ws.join(server.snowflake, session.user.snowflake)
+    return server
 
 
 # DELETE /<server_snowflake>/ (delete server if owner)
@@ -84,9 +97,38 @@ async def server_create(session: Session, data: Create.Server) -> Server:
 async def server_delete(session: Session, server_snowflake: str) -> Response.Success:
     """Delete server."""
     await app.db.server_set(snowflake=server_snowflake, user=session.user, delete=True)
+    app.ws.drop_server(server_snowflake)
     return Response.Success(response="Server deleted")
 
 
+# GET /<server_snowflake>/members/?limit=x&after=x (list members if user is in server)
+#     200 OK - Returns up to limit (default 100, at most 1000) members ordered by
+#              snowflake, pass the last snowflake as after for the next page
+#     401 Unauthorized - Token invalid
+#     404 Not Found - Server not found
+#     500 Internal Server Error
+
+
+@bp.get("/<server_snowflake>/members/")
+@tag(["Server", "Info"])
+@benchmark()
+@auth()
+@validate_querystring(Option.MembersQuery)
+@validate_response(List.Users, 200)
+async def server_member_list(
+    session: Session, server_snowflake: str, query_args: Option.MembersQuery
+) -> List.Users:
+    """Get a page of members of a server."""
+    return List.Users(
+        users=await app.db.member_get(
+            server=server_snowflake,
+            user=session.user,
+            limit=query_args.limit or 100,
+            after=query_args.after,
+        )
+    )
+
+
 # DELETE /<server_snowflake>/members/<user_snowflake> (remove user from server if owner or leave server if user)
 #     200 OK - User removed - returns nothing
 #     401 Unauthorized - Token invalid
@@ -104,10 +146,11 @@ async def server_user_delete(
 ) -> Response.Success:
     """Remove user from server."""
     await app.db.member_set(
-        user=session.user,
+        owner=session.user,
         server=await app.db.server_get(snowflake=server_snowflake, user=session.user),
         member=user_snowflake,
     )
+    app.ws.leave(server_snowflake, user_snowflake)
     return Response.Success(response="User removed")
 
 
@@ -190,7 +233,7 @@ async def auth_image(session: Session, server_snowflake: str):
         snowflake=server.snowflake,
         name=server.name,
         owner_name=server.owner.name,
-        members=len(server.members),
+        members=server.member_count,
     )
 
 
@@ -208,6 +251,31 @@ async def channel_list(session: Session, server_snowflake: str) -> List.Channels
     )
 
 
+# GET /<server_snowflake>/presence/ (who is online in the server, if user is in it)
+#     200 OK - Returns online count and the status of every online member
+#     401 Unauthorized - Token invalid
+#     404 Not Found - Server not found
+#     500 Internal Server Error
+
+
+@bp.get("/<server_snowflake>/presence/")
+@tag(["Server", "Info"])
+@benchmark()
+@auth()
+@validate_response(List.Presences, 200)
+async def server_presence(session: Session, server_snowflake: str) -> List.Presences:
+    """Get the members of a server that are online or idle."""
+    if server_snowflake not in await app.db.membership_get(user=session.user):
+        raise Error("Server not found", 404)
+    statuses = app.ws.present(server_snowflake)
+    return List.Presences(
+        online=len(statuses),
+        presences=[
+            Presence(snowflake=user, status=status) for user, status in statuses.items()
+        ],
+    )
+
+
 @bp.put("/<server_snowflake>/invite")
 @tag(["Invite", "Creation"])
 @benchmark()
@@ -230,8 +298,10 @@ async def invite_create(session: Session, server_snowflake: str) -> Invite:
 async def server_join(session: Session, data: Join) -> Server:
     """Join server with an invite code."""
     invite: Invite = await app.db.invite_get(invite=data.invite)
-    return await app.db.join_server(
+    server = await app.db.join_server(
         server=await app.db.server_get(snowflake=invite.server.snowflake, user=None),
         user=session.user,
         invite=invite,
     )
+    app.ws.join(server.snowflake, session.user.snowflake)
+    return server
@@ -0,0 +1,299 @@
+import asyncio
+import sys
+from time import monotonic
+from typing import Awaitable, Callable, Optional
+from uuid import uuid4
+
+import asyncpg
+
+import common.log
+import config
+
+log = common.log.get("backplane")
+
+# NOTIFY payloads are capped at 8000 bytes, anything bigger is sent in chunks
+# inside one transaction so listeners get them back to back
+NOTIFY_CHUNK = 7000
+# seconds a partly received chunked payload is kept, its sender may have died
+CHUNK_TIMEOUT = 30
+# seconds between attempts to reach a broker that went away, doubling up to the max
+RECONNECT_MIN = 0.5
+RECONNECT_MAX = 30
+# bytes the broker buffers for a worker that is not reading before dropping it,
+# the worker reconnects and resubscribes but loses what was sent meanwhile
+BROKER_BUFFER = 64 * 1024 * 1024
+
+
+class Backplane:
+    """Carries gateway traffic between workers. This one is single process and drops everything."""
+
+    # whether anything published actually leaves the process
+    remote = False
+
+    def __init__(self):
+        self.origin = uuid4().hex
+        self.handler: Optional[Callable[[str, str], None]] = None
+        # topics with their own handler instead of the one passed to start
+        self.handlers: dict[str, Callable[[str, str], None]] = {}
+        self.topics: set[str] = set()
+        self._commands: Optional[asyncio.Queue] = None
+        self._runner: Optional[asyncio.Task] = None
+
+    async def start(self, handler: Callable[[str, str], None]):
+        self.handler = handler
+        self._commands = asyncio.Queue()
+        await self._connect()
+        # anything subscribed before the backplane was up
+        for topic in self.topics:
+            self._queue(self._subscribe, topic)
+        self._runner = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._runner is not None:
+            self._runner.cancel()
+        await self._disconnect()
+
+    # subscribe, unsubscribe and publish are called from sync gateway code,
+    # so they queue up and a single task applies them in order
+    def subscribe(
+        self, topic: str, handler: Optional[Callable[[str, str], None]] = None
+    ):
+        if handler is not None:
+            self.handlers[topic] = handler
+        if topic not in self.topics:
+            self.topics.add(topic)
+            self._queue(self._subscribe, topic)
+
+    def unsubscribe(self, topic: str):
+        self.handlers.pop(topic, None)
+        if topic in self.topics:
+            self.topics.discard(topic)
+            self._queue(self._unsubscribe, topic)
+
+    def publish(self, topic: str, payload: str):
+        if self.remote:
+            self._queue(self._publish, topic, payload)
+
+    def _queue(self, command: Callable[..., Awaitable], *args):
+        if self._commands is not None:
+            self._commands.put_nowait((command, args))
+
+    async def _run(self):
+        while True:
+            command, args = await self._commands.get()
+            try:
+                await command(*args)
+            except Exception:
+                log.exception("command failed", command=command.__name__)
+
+    def _receive(self, topic: str, payload: str):
+        handler = self.handlers.get(topic, self.handler)
+        if handler is not None and topic in self.topics:
+            handler(topic, payload)
+
+    async def _connect(self):
+        pass
+
+    async def _disconnect(self):
+        pass
+
+    async def _subscribe(self, topic: str):
+        pass
+
+    async def _unsubscribe(self, topic: str):
+        pass
+
+    async def _publish(self, topic: str, payload: str):
+        pass
+
+
+class PostgresBackplane(Backplane):
+    """LISTEN/NOTIFY on the application database, one channel per topic."""
+
+    remote = True
+
+    def __init__(self, url: str):
+        super().__init__()
+        self.url = url
+        self._conn: Optional[asyncpg.Connection] = None
+        # set up as {"origin sequence": (first seen, [chunk, ...])}
+        self._chunks: dict[str, tuple[float, list[str]]] = {}
+        self._sequence = 0
+
+    def _channel(self, topic: str) -> str:
+        return f"riprap_{topic}"
+
+    async def _connect(self):
+        self._conn = await asyncpg.connect(self.url)
+
+    async def _disconnect(self):
+        if self._conn is not None:
+            await self._conn.close()
+
+    async def _subscribe(self, topic: str):
+        await self._conn.add_listener(self._channel(topic), self._notified)
+
+    async def _unsubscribe(self, topic: str):
+        await self._conn.remove_listener(self._channel(topic), self._notified)
+
+    async def _publish(self, topic: str, payload: str):
+        self._sequence += 1
+        chunks = [
+            payload[i : i + NOTIFY_CHUNK] for i in range(0, len(payload), NOTIFY_CHUNK)
+        ] or [""]
+        async with self._conn.transaction():
+            for index, chunk in enumerate(chunks):
+                await self._conn.execute(
+                    "SELECT pg_notify($1, $2)",
+                    self._channel(topic),
+                    f"{self.origin} {self._sequence} {index} {len(chunks)} {chunk}",
+                )
+
+    def _notified(self, connection, pid, channel: str, notification: str):
+        origin, sequence, index, count, chunk = notification.split(" ", 4)
+        if origin == self.origin:
+            return
+        topic = channel[len("riprap_") :]
+        if count == "1":
+            self._receive(topic, chunk)
+            return
+        key = f"{origin} {sequence}"
+        if key not in self._chunks:
+            self._expire()
+            self._chunks[key] = (monotonic(), [])
+        chunks = self._chunks[key][1]
+        chunks.append(chunk)
+        if len(chunks) == int(count):
+            self._chunks.pop(key)
+            self._receive(topic, "".join(chunks))
+
+    def _expire(self):
+        now = monotonic()
+        for key in [k for k, v in self._chunks.items() if now - v[0] > CHUNK_TIMEOUT]:
+            log.warning("dropped an incomplete payload", key=key)
+            self._chunks.pop(key)
+
+
+class UnixBackplane(Backplane):
+    """Talks to a broker started with `python -m common.backplane <socket path>`."""
+
+    remote = True
+
+    def __init__(self, path: str):
+        super().__init__()
+        self.path = path
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._listener: Optional[asyncio.Task] = None
+
+    async def _connect(self):
+        await self._open()
+        self._listener = asyncio.create_task(self._listen())
+
+    async def _open(self):
+        self._reader, self._writer = await asyncio.open_unix_connection(
+            self.path, limit=2**24
+        )
+
+    async def _disconnect(self):
+        if self._listener is not None:
+            self._listener.cancel()
+        if self._writer is not None:
+            self._writer.close()
+
+    async def _send(self, line: str):
+        if self._writer is None:
+            # the broker is down, subscriptions are replayed once it is back
+            # and anything published meanwhile is lost
+            return
+        self._writer.write(line.encode("utf-8") + b"\n")
+        await self._writer.drain()
+
+    async def _subscribe(self, topic: str):
+        await self._send(f"+{topic}")
+
+    async def _unsubscribe(self, topic: str):
+        await self._send(f"-{topic}")
+
+    async def _publish(self, topic: str, payload: str):
+        await self._send(f"!{topic} {payload}")
+
+    async def _listen(self):
+        while True:
+            try:
+                line = await self._reader.readline()
+            except ConnectionError:
+                line = b""
+            if not line:
+                log.error("broker went away", path=self.path)
+                await self._reconnect()
+                continue
+            topic, payload = line.decode("utf-8").rstrip("\n")[1:].split(" ", 1)
+            self._receive(topic, payload)
+
+    async def _reconnect(self):
+        self._writer.close()
+        self._writer = None
+        delay = RECONNECT_MIN
+        while True:
+            await asyncio.sleep(delay)
+            try:
+                await self._open()
+                break
+            except OSError:
+                delay = min(delay * 2, RECONNECT_MAX)
+        # the same as start does for anything subscribed before the backplane was up
+        for topic in self.topics:
+            await self._send(f"+{topic}")
+        log.info("reconnected to broker", path=self.path, topics=len(self.topics))
+
+
+def from_config() -> Backplane:
+    kind = getattr(config, "BACKPLANE", None)
+    if kind == "postgres":
+        return PostgresBackplane(getattr(config, "BACKPLANE_URL", config.DATABASE_URL))
+    if kind == "unix":
+        return UnixBackplane(getattr(config, "BACKPLANE_URL", "/tmp/riprap.sock"))
+    return Backplane()
+
+
+async def broker(path: str):
+    # set up as {"topic": {StreamWriter, ...}}
+    topics: dict[str, set[asyncio.StreamWriter]] = {}
+
+    async def worker(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        subscribed: set[str] = set()
+        try:
+            while line := await reader.readline():
+                kind, rest = line[:1], line[1:].rstrip(b"\n").decode("utf-8")
+                if kind == b"+":
+                    subscribed.add(rest)
+                    topics.setdefault(rest, set()).add(writer)
+                elif kind == b"-":
+                    subscribed.discard(rest)
+                    topics.get(rest, set()).discard(writer)
+                elif kind == b"!":
+                    topic = rest.split(" ", 1)[0]
+                    for other in topics.get(topic, ()):
+                        if other is writer or other.is_closing():
+                            continue
+                        # never waited on, so one slow worker can not hold up
+                        # the rest, it is dropped once too much piles up
+                        other.write(line)
+                        buffered = other.transport.get_write_buffer_size()
+                        if buffered > BROKER_BUFFER:
+                            log.warning("dropped a slow worker", buffered=buffered)
+                            other.transport.abort()
+        finally:
+            for topic in subscribed:
+                topics.get(topic, set()).discard(writer)
+            writer.close()
+
+    server = await asyncio.start_unix_server(worker, path, limit=2**24)
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+    common.log.start()
+    asyncio.run(broker(sys.argv[1] if len(sys.argv) > 1 else "/tmp/riprap.sock"))
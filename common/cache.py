@@ -0,0 +1,300 @@
+import asyncio
+import math
+import random
+import sys
+from collections import OrderedDict
+from time import monotonic
+from typing import Any, Awaitable, Callable, Hashable, Iterable, Optional
+
+import config
+from common.backplane import Backplane
+
+# per namespace limits, a namespace is the qualified name of the cached function
+# such as "User.from_prisma".
+# CACHE_LIMITS overrides them per namespace as {"name": {"entries": n, "bytes": n}}
+MAX_ENTRIES = getattr(config, "CACHE_MAX_ENTRIES", 10000)
+MAX_BYTES = getattr(config, "CACHE_MAX_BYTES", 64 * 1024 * 1024)
+LIMITS: dict[str, dict[str, int]] = getattr(config, "CACHE_LIMITS", {})
+# how long (in seconds) a caller waits on a load another caller started
+FLIGHT_TIMEOUT = getattr(config, "CACHE_FLIGHT_TIMEOUT", 10)
+# hits in the last REFRESH_WINDOW of an entry's ttl reload it in the background,
+# the window starts up to REFRESH_JITTER of itself later per entry
+REFRESH_WINDOW = getattr(config, "CACHE_REFRESH_WINDOW", 0.2)
+REFRESH_JITTER = getattr(config, "CACHE_REFRESH_JITTER", 0.5)
+
+MISSING = object()
+
+
+def measure(value: Any, depth: int = 6) -> tuple[int, set[str]]:
+    """Approximate size of a cached value and the snowflakes of everything in it.
+
+    Shared objects are counted once per reference, anything nested deeper than
+    depth only counts its own header.
+    """
+    tags: set[str] = set()
+    return _measure(value, depth, tags), tags
+
+
+def _measure(value: Any, depth: int, tags: set[str]) -> int:
+    size = sys.getsizeof(value)
+    if depth == 0 or isinstance(value, (str, bytes, int, float, bool)):
+        return size
+    if isinstance(value, dict):
+        return size + sum(
+            _measure(k, depth - 1, tags) + _measure(v, depth - 1, tags)
+            for k, v in value.items()
+        )
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return size + sum(_measure(x, depth - 1, tags) for x in value)
+    fields = getattr(value, "__dict__", None)
+    if fields is None:
+        return size
+    snowflake = fields.get("snowflake")
+    if snowflake is not None:
+        tags.add(str(snowflake))
+    return (
+        size
+        + sys.getsizeof(fields)
+        + sum(_measure(x, depth - 1, tags) for x in fields.values())
+    )
+
+
+class Entry:
+    __slots__ = ("value", "expires", "refresh", "size", "tags")
+
+    def __init__(
+        self, value: Any, expires: float, refresh: float, size: int, tags: set[str]
+    ):
+        self.value = value
+        self.expires = expires
+        # when hits start reloading it, inf once a reload is under way
+        self.refresh = refresh
+        self.size = size
+        # snowflakes of everything the value embeds, a write to any evicts it
+        self.tags = tags
+
+
+class SingleFlight:
+    """Concurrent calls with the same key share one run of the function.
+
+    Every caller gets the result or the exception of that run, nothing is kept
+    once it finishes. Callers that joined a run give up after timeout, and any
+    caller that times out or is cancelled leaves the run going for the others.
+    """
+
+    def __init__(self, timeout: Optional[float] = FLIGHT_TIMEOUT):
+        self.timeout = timeout
+        self.flights: dict[Hashable, asyncio.Future] = {}
+        # calls that started a run, and calls that joined one already running
+        self.started = 0
+        self.shared = 0
+
+    async def do(
+        self, key: Hashable, func: Callable[..., Awaitable], *args, **kwargs
+    ) -> Any:
+        future = self.flights.get(key)
+        if future is None:
+            future = asyncio.ensure_future(func(*args, **kwargs))
+            self.flights[key] = future
+            future.add_done_callback(lambda x: self._land(key, x))
+            self.started += 1
+            return await asyncio.shield(future)
+        self.shared += 1
+        return await asyncio.wait_for(asyncio.shield(future), self.timeout)
+
+    def _land(self, key: Hashable, future: asyncio.Future):
+        if self.flights.get(key) is future:
+            self.flights.pop(key)
+        # retrieved here so a run every waiter gave up on does not warn
+        if not future.cancelled():
+            future.exception()
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": len(self.flights),
+            "started": self.started,
+            "shared": self.shared,
+        }
+
+
+class Namespace:
+    """An LRU map bounded by entry count and approximate bytes, entries expire after their ttl."""
+
+    def __init__(self, name: str, entries: int, bytes: int):
+        self.name = name
+        self.max_entries = entries
+        self.max_bytes = bytes
+        # least recently used first
+        self.entries: OrderedDict[Hashable, Entry] = OrderedDict()
+        # set up as {"snowflake": {key, ...}}
+        self.tags: dict[str, set[Hashable]] = {}
+        # bumped by every invalidation, a load that started before one is not kept
+        self.version = 0
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.refreshes = 0
+        self.invalidations = 0
+        # misses on the same key while the value is being loaded share one load
+        self.flights = SingleFlight()
+
+    def get(
+        self,
+        key: Hashable,
+        default: Any = MISSING,
+        refresh: Optional[Callable[[], Any]] = None,
+    ) -> Any:
+        # refresh is called at most once per entry, on the first hit inside its
+        # refresh window, and should put a new value for the key
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        now = monotonic()
+        if entry.expires <= now:
+            self.expirations += 1
+            self._pop(key)
+            self.misses += 1
+            return default
+        self.entries.move_to_end(key)
+        self.hits += 1
+        if entry.refresh <= now and refresh is not None:
+            entry.refresh = math.inf
+            self.refreshes += 1
+            refresh()
+        return entry.value
+
+    def put(self, key: Hashable, value: Any, ttl: float, version: Optional[int] = None):
+        # version is what self.version was when the value started loading
+        if version is not None and version != self.version:
+            return
+        if key in self.entries:
+            self._pop(key)
+        now = monotonic()
+        window = ttl * REFRESH_WINDOW * (1 - REFRESH_JITTER * random.random())
+        size, tags = measure(value)
+        entry = Entry(value, now + ttl, now + ttl - window, size, tags)
+        self.entries[key] = entry
+        self.bytes += entry.size
+        for tag in tags:
+            keys = self.tags.get(tag)
+            if keys is None:
+                keys = self.tags[tag] = set()
+            keys.add(key)
+        while len(self.entries) > self.max_entries or (
+            self.bytes > self.max_bytes and len(self.entries) > 1
+        ):
+            self._pop(next(iter(self.entries)))
+            self.evictions += 1
+
+    def pop(self, key: Hashable):
+        if key in self.entries:
+            self._pop(key)
+
+    def invalidate(self, snowflakes: Iterable[str]):
+        self.version += 1
+        for snowflake in snowflakes:
+            for key in list(self.tags.get(snowflake, ())):
+                self._pop(key)
+                self.invalidations += 1
+
+    def clear(self):
+        self.version += 1
+        self.entries.clear()
+        self.tags.clear()
+        self.bytes = 0
+
+    def _pop(self, key: Hashable):
+        entry = self.entries.pop(key)
+        self.bytes -= entry.size
+        for tag in entry.tags:
+            keys = self.tags[tag]
+            keys.discard(key)
+            if len(keys) == 0:
+                self.tags.pop(tag)
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self.entries),
+            "bytes": self.bytes,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "refreshes": self.refreshes,
+            "invalidations": self.invalidations,
+            "flights": self.flights.stats(),
+        }
+
+
+class Cache:
+    """The process wide cache behind sync_cache and async_cache, one namespace per function."""
+
+    def __init__(self):
+        self.namespaces: dict[str, Namespace] = {}
+        # bumped by every invalidation, so coalesced reads started before a
+        # write are not shared with callers that come after it
+        self.version = 0
+        self.backplane: Optional[Backplane] = None
+
+    def attach(self, backplane: Backplane):
+        # invalidations go out to and come in from the other workers
+        self.backplane = backplane
+        backplane.subscribe("cache", self.receive)
+
+    def invalidate(
+        self,
+        *snowflakes: Optional[int | str],
+        namespaces: Optional[Iterable[str]] = None,
+    ):
+        # namespaces limits it to the entries of those functions, for writes
+        # that only change something a few kinds of value carry
+        snowflakes = [str(x) for x in snowflakes if x is not None]
+        if len(snowflakes) == 0:
+            return
+        namespaces = None if namespaces is None else list(namespaces)
+        self._invalidate(snowflakes, namespaces)
+        if self.backplane is not None:
+            scope = "*" if namespaces is None else ",".join(namespaces)
+            self.backplane.publish("cache", f"{scope} {' '.join(snowflakes)}")
+
+    def receive(self, topic: str, payload: str):
+        scope, *snowflakes = payload.split()
+        self._invalidate(snowflakes, None if scope == "*" else scope.split(","))
+
+    def _invalidate(self, snowflakes: list[str], namespaces: Optional[list[str]]):
+        self.version += 1
+        if namespaces is None:
+            namespaces = self.namespaces
+        for name in namespaces:
+            namespace = self.namespaces.get(name)
+            if namespace is not None:
+                namespace.invalidate(snowflakes)
+
+    def namespace(self, name: str) -> Namespace:
+        namespace = self.namespaces.get(name)
+        if namespace is None:
+            limits = LIMITS.get(name, {})
+            namespace = self.namespaces[name] = Namespace(
+                name,
+                limits.get("entries", MAX_ENTRIES),
+                limits.get("bytes", MAX_BYTES),
+            )
+        return namespace
+
+    def clear(self, name: Optional[str] = None):
+        self.version += 1
+        for namespace in self.namespaces.values():
+            if name is None or namespace.name == name:
+                namespace.clear()
+
+    def stats(self) -> dict:
+        return {
+            "entries": sum(len(x.entries) for x in self.namespaces.values()),
+            "bytes": sum(x.bytes for x in self.namespaces.values()),
+            "namespaces": {x.name: x.stats() for x in self.namespaces.values()},
+        }
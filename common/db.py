@@ -12,7 +12,16 @@ from uuid import uuid1
 import zlib
 import bcrypt
 from databases import Database
-from common.primitive import Channel, Invite, Message, Server, Session, User, Error
+from common.primitive import (
+    Channel,
+    Invite,
+    Message,
+    Ready,
+    Server,
+    Session,
+    User,
+    Error,
+)
 from snowflake import SnowflakeGenerator
 import prisma
 from prisma.models import (
@@ -23,14 +32,25 @@ from prisma.models import (
 )
 from PIL import Image
 import config
+from common.cache import Cache
+from common.utils import async_cache, coalesce
+
+# the most members member_get returns in one page
+MEMBER_PAGE = 1000
+# the cached values that carry a channel's message count, cached messages only
+# embed channels without it
+MESSAGE_COUNT = ("Channel.from_prisma", "Server.from_prisma")
 
 # from common.utils import cache
 
 
 class RIPRAPDatabase:
-    def __init__(self, url):
+    def __init__(self, url, cache: Optional[Cache] = None):
         self.url = url
         self._db = None
+        # every write below reports the snowflakes it touched, so cached values
+        # that embed them are evicted here and on the other workers
+        self.cache = cache
         self.snowflake_gen = SnowflakeGenerator(0)
         self.uuid = uuid1
 
@@ -39,6 +59,12 @@ class RIPRAPDatabase:
         # self._db.server = self.url
         await self._db.connect()
 
+    def _invalidate(
+        self, *snowflakes: Optional[int | str], namespaces: Optional[tuple] = None
+    ):
+        if self.cache is not None:
+            self.cache.invalidate(*snowflakes, namespaces=namespaces)
+
     # @cache()
     # async def _userModelToUser(
     #     self,
@@ -119,6 +145,7 @@ class RIPRAPDatabase:
     # def _b64obj_to_string(self, b64obj: prisma.Base64) -> str:ToUser
     #     return base64.b64encode(b64obj.decode()).decode("utf-8")
 
+    @coalesce()
     async def user_get(
         self,
         *,
@@ -199,6 +226,7 @@ class RIPRAPDatabase:
                 }
                 await self._db.user.delete(where={"snowflake": snowflake})
                 deleteduser = await self._db.user.create(data=newuserdata)
+                self._invalidate(snowflake)
                 return User.from_prisma(deleteduser, 1)
             else:
                 verified = [False, False]
@@ -227,11 +255,11 @@ class RIPRAPDatabase:
                         self._format_picture(picture) or user.picture.decode()
                     ),
                 }
-            return User.from_prisma(
-                await self._db.user.update(
-                    data=newuserinfo, where={"snowflake": snowflake}
-                )
+            user = await self._db.user.update(
+                data=newuserinfo, where={"snowflake": snowflake}
             )
+            self._invalidate(snowflake)
+            return User.from_prisma(user)
         else:
             if delete:
                 raise Error("Cannot delete user without Snowflake", 400)
@@ -263,6 +291,7 @@ class RIPRAPDatabase:
             raise Error("Email is not valid", 400)
         return email
 
+    @coalesce()
     async def session_get(
         self, *, token: str, listall: bool = False
     ) -> Session | list[Session]:
@@ -372,6 +401,7 @@ class RIPRAPDatabase:
             rgb[i] = int((rgb[i] / total) * amount)
         return tuple(rgb + [255])
 
+    @coalesce()
     async def server_get(self, *, snowflake: int | str, user: User) -> Server:
         snowflake = int(snowflake)
         where = {
@@ -383,15 +413,17 @@ class RIPRAPDatabase:
             where=where,
             include={
                 "owner": True,
-                "members": {
-                    "include": {"user": True},
-                },
                 "channels": True,
             },
         )
         if len(server) == 0:
             raise Error("Server not found", 404)
-        return Server.from_prisma(server[0])
+        return Server.from_prisma(
+            server[0],
+            member_count=await self._db.serverusersrelation.count(
+                where={"serverSnowflake": snowflake}
+            ),
+        )
 
     async def server_set(
         self,
@@ -408,9 +440,6 @@ class RIPRAPDatabase:
                 where={"snowflake": snowflake},
                 include={
                     "owner": True,
-                    "members": {
-                        "include": {"user": True},
-                    },
                 },
             )
             if server.owner.snowflake != int(user.snowflake):
@@ -419,22 +448,24 @@ class RIPRAPDatabase:
                 raise Error("Server not found", 404)
             if delete:
                 await self._db.server.delete(where={"snowflake": snowflake})
+                self._invalidate(snowflake)
                 return None
             newdata = {
                 "name": name or server.name,
                 "picture": self._format_picture(picture) or server.picture,
             }
             await self._db.server.update(where={"snowflake": snowflake}, data=newdata)
+            self._invalidate(snowflake)
             return Server.from_prisma(
                 await self._db.server.find_unique(
                     where={"snowflake": snowflake},
                     include={
                         "owner": True,
-                        "members": {
-                            "include": {"user": True},
-                        },
                     },
                 ),
+                member_count=await self._db.serverusersrelation.count(
+                    where={"serverSnowflake": snowflake}
+                ),
                 nocache=True,
             )
         else:
@@ -457,22 +488,21 @@ class RIPRAPDatabase:
                     "user": {"connect": {"snowflake": user.snowflake}},
                 }
             )
+            # the owner's server list
+            self._invalidate(user.snowflake)
             server = await self._db.server.find_unique(
                 where={"snowflake": server.snowflake},
                 include={
-                    "members": {
-                        "include": {
-                            "user": True,
-                        },
-                    },
                     "owner": True,
                 },
             )
             return Server.from_prisma(
                 server,
+                member_count=1,
                 nocache=True,
             )
 
+    @coalesce()
     async def channel_get(
         self, *, channel_snowflake: int | str, user: User, includeserver: bool = False
     ) -> Channel:
@@ -484,9 +514,7 @@ class RIPRAPDatabase:
         }
 
         if includeserver:
-            include["server"] = {
-                "include": {"members": {"include": {"user": True}}, "owner": True}
-            }
+            include["server"] = {"include": {"owner": True}}
         channel = await self._db.channel.find_many(
             where={
                 "snowflake": channel_snowflake,
@@ -496,7 +524,19 @@ class RIPRAPDatabase:
         )
         if len(channel) == 0:
             raise Error("Channel not found", 404)
-        return Channel.from_prisma(channel[0])
+        return Channel.from_prisma(channel[0], nocache=includeserver)
+
+    @async_cache()
+    async def channel_find(self, *, channel_snowflake: int | str) -> Channel:
+        # a channel and the server it is in, whoever asks, for callers that check
+        # membership themselves, a channel never moves so this is cached
+        channel = await self._db.channel.find_unique(
+            where={"snowflake": int(channel_snowflake)},
+            include={"server": {"include": {"owner": True}}},
+        )
+        if channel is None:
+            raise Error("Channel not found", 404)
+        return Channel.from_prisma(channel, 1, nocache=True)
 
     async def channel_set(
         self,
@@ -527,21 +567,20 @@ class RIPRAPDatabase:
                 )
             if delete:
                 await self._db.channel.delete(where={"snowflake": snowflake})
+                self._invalidate(snowflake, channel[0].serverSnowflake)
                 return None
             newdata = {
                 "name": name or channel[0].name,
                 "picture": self._format_picture(picture) or channel[0].picture,
             }
             await self._db.channel.update(where={"snowflake": snowflake}, data=newdata)
+            self._invalidate(snowflake)
             return Channel.from_prisma(
                 await self._db.channel.find_unique(
                     where={"snowflake": snowflake},
                     include={
                         "server": {
                             "include": {
-                                "members": {
-                                    "include": {"user": True},
-                                },
                                 "owner": True,
                             },
                         },
@@ -570,15 +609,14 @@ class RIPRAPDatabase:
                     "messages": True,
                 },
             )
+            # the server's channel list
+            self._invalidate(server_snowflake)
             return Channel.from_prisma(
                 await self._db.channel.find_unique(
                     where={"snowflake": channel.snowflake},
                     include={
                         "server": {
                             "include": {
-                                "members": {
-                                    "include": {"user": True},
-                                },
                                 "owner": True,
                             },
                         },
@@ -604,6 +642,7 @@ class RIPRAPDatabase:
         bg.save(bytesout, format="PNG")
         return bytesout.getvalue()
 
+    @coalesce()
     async def message_get(
         self,
         *,
@@ -639,21 +678,27 @@ class RIPRAPDatabase:
         snowflake: Optional[int | str] = None,
         content: Optional[str] = None,
         delete: bool = False,
+        member: bool = False,
     ) -> Optional[Message]:
+        # member is for callers that already know the user is in the channel's
+        # server, a new message is then the only query
         user_snowflake = int(user.snowflake)
-        userstuff = await self._db.serverusersrelation.find_many(
-            where={"user": {"snowflake": user_snowflake}},
-            include={"server": {"include": {"channels": True, "owner": True}}},
-        )
-        owner = False
-        found = False
-        for server in userstuff:
-            if int(channel.snowflake) in [x.snowflake for x in server.server.channels]:
-                found = True
-                if found:
-                    owner = server.server.owner.snowflake == user_snowflake
-        if not found:
-            raise Error("You are not in this channel", 401)
+        if not member or snowflake is not None:
+            userstuff = await self._db.serverusersrelation.find_many(
+                where={"user": {"snowflake": user_snowflake}},
+                include={"server": {"include": {"channels": True, "owner": True}}},
+            )
+            owner = False
+            found = False
+            for server in userstuff:
+                if int(channel.snowflake) in [
+                    x.snowflake for x in server.server.channels
+                ]:
+                    found = True
+                    if found:
+                        owner = server.server.owner.snowflake == user_snowflake
+            if not found:
+                raise Error("You are not in this channel", 401)
         if snowflake is not None:
             snowflake = int(snowflake)
             message = await self._db.message.find_many(
@@ -668,6 +713,8 @@ class RIPRAPDatabase:
                 raise Error("Message not found", 404)
             if (message[0].author.snowflake == user_snowflake or owner) and delete:
                 await self._db.message.delete(where={"snowflake": snowflake})
+                self._invalidate(snowflake)
+                self._invalidate(channel.snowflake, namespaces=MESSAGE_COUNT)
                 return None
 
             if message[0].author.snowflake != user_snowflake:
@@ -675,6 +722,7 @@ class RIPRAPDatabase:
 
             newdata = {"content": content or message[0].content}
             await self._db.message.update(where={"snowflake": snowflake}, data=newdata)
+            self._invalidate(snowflake)
             return Message.from_prisma(
                 await self._db.message.find_unique(
                     where={"snowflake": snowflake},
@@ -694,16 +742,14 @@ class RIPRAPDatabase:
                     "channel": {"connect": {"snowflake": int(channel.snowflake)}},
                     "author": {"connect": {"snowflake": user_snowflake}},
                 },
+                include={
+                    "author": True,
+                    "channel": True,
+                },
             )
-            return Message.from_prisma(
-                await self._db.message.find_unique(
-                    where={"snowflake": message.snowflake},
-                    include={
-                        "author": True,
-                        "channel": True,
-                    },
-                )
-            )
+            # only the count changed, the channel's messages stay cached
+            self._invalidate(channel.snowflake, namespaces=MESSAGE_COUNT)
+            return Message.from_prisma(message)
 
     def _format_picture(self, picture) -> Optional[bytes]:
         if picture is None:
@@ -725,17 +771,152 @@ class RIPRAPDatabase:
                 raise Error("User is required", 400)
             if server.owner.snowflake != owner.snowflake:
                 raise Error("You are not the owner of this server", 401)
-            return await self._db.server.update(
+            result = await self._db.server.update(
                 where={"snowflake": int(server.snowflake)},
                 data={"members": {"disconnect": {"snowflake": int(member)}}},
             )
         else:
             if member is None:
                 raise Error("Member is required", 400)
-            return await self._db.server.update(
+            result = await self._db.server.update(
                 where={"snowflake": int(server.snowflake)},
                 data={"members": {"connect": {"snowflake": int(member)}}},
             )
+        self._invalidate(server.snowflake, member)
+        return result
+
+    @coalesce()
+    async def member_get(
+        self,
+        *,
+        server: int | str,
+        user: User,
+        limit: int = 100,
+        after: Optional[int | str] = None,
+    ) -> list[User]:
+        # one page of members ordered by snowflake, pass the last one as after
+        # for the next page
+        where = {
+            "serverSnowflake": int(server),
+            "server": {"members": {"some": {"userSnowflake": int(user.snowflake)}}},
+        }
+        if after is not None:
+            where["userSnowflake"] = {"gt": int(after)}
+        relations = await self._db.serverusersrelation.find_many(
+            where=where,
+            order={"userSnowflake": "asc"},
+            take=min(max(limit, 1), MEMBER_PAGE),
+            include={"user": True},
+        )
+        if len(relations) == 0 and str(server) not in await self.membership_get(
+            user=user
+        ):
+            raise Error("Server not found", 404)
+        return [User.from_prisma(x.user, 1) for x in relations]
+
+    @coalesce()
+    async def membership_get(self, *, user: User) -> list[str]:
+        relations = await self._db.serverusersrelation.find_many(
+            where={"userSnowflake": int(user.snowflake)},
+        )
+        return [str(x.serverSnowflake) for x in relations]
+
+    @coalesce()
+    async def ready_get(self, *, user: User, messages: int = 0) -> Ready:
+        # everything a client needs after identify, the number of queries does not
+        # depend on how many servers or channels the user has, members are left
+        # to member_get
+        user_snowflake = int(user.snowflake)
+        thisuser = await self._db.user.find_unique(
+            where={"snowflake": user_snowflake},
+            include={"friends": True},
+        )
+        if thisuser is None:
+            raise Error("User not found", 404)
+        servers = await self._db.server.find_many(
+            where={"members": {"some": {"userSnowflake": user_snowflake}}},
+            include={
+                "owner": True,
+                "channels": True,
+            },
+        )
+        membercounts = {
+            str(x["serverSnowflake"]): x["_count"]["_all"]
+            for x in await self._db.serverusersrelation.group_by(
+                ["serverSnowflake"],
+                where={
+                    "server": {"members": {"some": {"userSnowflake": user_snowflake}}}
+                },
+                count=True,
+            )
+        }
+        counts = {
+            str(x["channelSnowflake"]): x["_count"]["_all"]
+            for x in await self._db.message.group_by(
+                ["channelSnowflake"],
+                where={
+                    "channel": {
+                        "server": {
+                            "members": {"some": {"userSnowflake": user_snowflake}}
+                        }
+                    }
+                },
+                count=True,
+            )
+        }
+        latest: dict[str, list[Message]] = {}
+        if messages > 0:
+            # the newest n per channel in one pass, then load just those rows
+            rows = await self._db.query_raw(
+                """
+                SELECT "snowflake" FROM (
+                    SELECT m."snowflake", ROW_NUMBER() OVER (
+                        PARTITION BY m."channelSnowflake" ORDER BY m."snowflake" DESC
+                    ) AS "row"
+                    FROM "Message" m
+                    JOIN "Channel" c ON c."snowflake" = m."channelSnowflake"
+                    JOIN "ServerUsersRelation" r
+                        ON r."serverSnowflake" = c."serverSnowflake"
+                    WHERE r."userSnowflake" = $1
+                ) latest
+                WHERE "row" <= $2
+                """,
+                user_snowflake,
+                messages,
+            )
+            if len(rows) > 0:
+                for message in await self._db.message.find_many(
+                    where={"snowflake": {"in": [int(x["snowflake"]) for x in rows]}},
+                    order={"snowflake": "desc"},
+                    include={"author": True, "channel": True},
+                ):
+                    latest.setdefault(str(message.channelSnowflake), []).append(
+                        Message.from_prisma(message)
+                    )
+        readyservers = []
+        for server in servers:
+            server = Server.from_prisma(
+                server, member_count=membercounts.get(str(server.snowflake), 0)
+            )
+            # from_prisma results are cached and shared, copy before filling in
+            readyservers.append(
+                server.copy(
+                    update={
+                        "channels": [
+                            x.copy(update={"message_count": counts.get(x.snowflake, 0)})
+                            for x in server.channels or []
+                        ]
+                    }
+                )
+            )
+        return Ready(
+            # session_get caches this user without friends under the same key
+            user=User.from_prisma(thisuser, nocache=True).copy(
+                update={"servers": None}
+            ),
+            servers=readyservers,
+            messages=latest,
+        )
 
     async def invite_set(
         self,
@@ -758,26 +939,29 @@ class RIPRAPDatabase:
             if thisinvite.server.owner.snowflake != user.snowflake:
                 raise Error("You are not the owner of this server", 401)
             await self._db.serverinvites.delete(where={"snowflake": invite})
+            # the server's invite list
+            self._invalidate(thisinvite.server.snowflake)
             return None
         else:
-            return Invite.from_prisma(
-                await self._db.serverinvites.create(
-                    data={
-                        "invite": hashlib.sha1(
-                            codecs.encode(str(next(self.snowflake_gen)), "ascii")
-                        ).hexdigest(),
-                        "server": {"connect": {"snowflake": int(server.snowflake)}},
-                    },
-                    include={
-                        "server": {
-                            "include": {
-                                "owner": True,
-                            }
-                        },
+            thisinvite = await self._db.serverinvites.create(
+                data={
+                    "invite": hashlib.sha1(
+                        codecs.encode(str(next(self.snowflake_gen)), "ascii")
+                    ).hexdigest(),
+                    "server": {"connect": {"snowflake": int(server.snowflake)}},
+                },
+                include={
+                    "server": {
+                        "include": {
+                            "owner": True,
+                        }
                     },
-                )
+                },
             )
+            self._invalidate(server.snowflake)
+            return Invite.from_prisma(thisinvite)
 
+    @coalesce()
     async def invite_get(self, *, invite: str) -> Invite:
         thisinvite = await self._db.serverinvites.find_unique(
             where={
@@ -796,10 +980,16 @@ class RIPRAPDatabase:
         return Invite.from_prisma(thisinvite)
 
     async def join_server(self, *, server: Server, user: User, invite: Invite):
-        members = [x.snowflake for x in server.members]
-        for member in members:
-            if member == user.snowflake:
-                raise Error("You are already in this server", 400)
+        if (
+            await self._db.serverusersrelation.find_first(
+                where={
+                    "serverSnowflake": int(server.snowflake),
+                    "userSnowflake": int(user.snowflake),
+                }
+            )
+            is not None
+        ):
+            raise Error("You are already in this server", 400)
 
         await self._db.serverusersrelation.create(
             data={
@@ -808,7 +998,8 @@ class RIPRAPDatabase:
             }
         )
         await self._db.serverinvites.delete(where={"invite": invite.invite})
-        return server
+        self._invalidate(server.snowflake, user.snowflake)
+        return server.copy(update={"member_count": (server.member_count or 0) + 1})
 
     # async def ratelimited_get(
     #     self, endpoint_id: str, session: Primitive.Session, t: int, maxuses: int
@@ -0,0 +1,62 @@
+from typing import Any
+
+import msgpack
+from quart import Request, has_request_context, request
+from quart_schema.extension import JSONProvider
+
+JSON = "application/json"
+MSGPACK = "application/msgpack"
+
+
+def snowflakes_to_int(thing: Any) -> Any:
+    # snowflakes are decimal strings in json, binary clients get real 64 bit ints
+    if isinstance(thing, dict):
+        return {
+            key: int(value)
+            if key == "snowflake" and isinstance(value, str) and value.isdigit()
+            else snowflakes_to_int(value)
+            for key, value in thing.items()
+        }
+    if isinstance(thing, (list, tuple)):
+        return [snowflakes_to_int(x) for x in thing]
+    return thing
+
+
+def pack(thing: Any) -> bytes:
+    return msgpack.packb(snowflakes_to_int(thing), default=str)
+
+
+def pack_array_header(length: int) -> bytes:
+    return msgpack.Packer().pack_array_header(length)
+
+
+def unpack(nibble: bytes) -> Any:
+    return msgpack.unpackb(nibble)
+
+
+def wants_msgpack() -> bool:
+    return (
+        has_request_context()
+        and request.accept_mimetypes.best_match([JSON, MSGPACK]) == MSGPACK
+    )
+
+
+class RIPRAPJSONProvider(JSONProvider):
+    def response(self, *args, **kwargs):
+        if wants_msgpack():
+            return self._app.response_class(
+                pack(self._prepare_response_obj(args, kwargs)), mimetype=MSGPACK
+            )
+        return super().response(*args, **kwargs)
+
+
+class RIPRAPRequest(Request):
+    async def get_json(self, force=False, silent=False, cache=True) -> Any:
+        if self.mimetype != MSGPACK:
+            return await super().get_json(force, silent, cache)
+        try:
+            return unpack(await self.get_data(cache=cache, as_text=False))
+        except ValueError as error:
+            if silent:
+                return None
+            return self.on_json_loading_failed(error)
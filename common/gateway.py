@@ -0,0 +1,430 @@
+import asyncio
+import heapq
+import json
+from typing import Any, Iterable, Optional
+
+from common.backplane import Backplane
+from common.encoding import pack
+from common.timers import Timer, TimerWheel
+
+OFFLINE = "offline"
+ONLINE = "online"
+IDLE = "idle"
+# the status a user shows is the most present one any of their sockets has
+RANK = {OFFLINE: 0, IDLE: 1, ONLINE: 2}
+
+SEQ_MSGPACK = pack("seq")
+
+
+class Event:
+    """A gateway frame, encoded at most once and shared by every recipient."""
+
+    __slots__ = ("code", "data", "id", "server", "channel", "_json", "_msgpack")
+
+    def __init__(self, code: int, data: Optional[Any] = None, id: Optional[Any] = None):
+        self.code = code
+        self.data = data
+        # echoed back from the request an rpc reply answers, None for dispatches
+        self.id = id
+        # where the event comes from, only used to match connection intents
+        self.server: Optional[str] = None
+        self.channel: Optional[str] = None
+        self._json = None
+        self._msgpack = None
+
+    def _dict(self) -> dict:
+        if self.id is None:
+            return {"code": self.code, "data": self.data}
+        return {"code": self.code, "data": self.data, "id": self.id}
+
+    @staticmethod
+    def of(data: "dict | Event") -> "Event":
+        if isinstance(data, Event):
+            return data
+        return Event(data["code"], data.get("data", None))
+
+    @staticmethod
+    def decode(encoded: str) -> "Event":
+        data = json.loads(encoded)
+        event = Event(data["code"], data.get("data", None), data.get("id", None))
+        event._json = encoded
+        return event
+
+    # what goes over the backplane, the routing plus the shared json
+    def wire(self) -> str:
+        return f"{self.server or '-'} {self.channel or '-'} {self.json}"
+
+    @staticmethod
+    def unwire(payload: str) -> "Event":
+        server, channel, encoded = payload.split(" ", 2)
+        event = Event.decode(encoded)
+        event.server = None if server == "-" else server
+        event.channel = None if channel == "-" else channel
+        return event
+
+    @property
+    def json(self) -> str:
+        if self._json is None:
+            self._json = json.dumps(self._dict())
+        return self._json
+
+    @property
+    def msgpack(self) -> bytes:
+        if self._msgpack is None:
+            self._msgpack = pack(self._dict())
+        return self._msgpack
+
+    # the sequence number differs per connection, so it is spliced in front of
+    # the shared encoding instead of encoding the event again
+    def json_seq(self, seq: int) -> str:
+        return f'{{"seq":{seq},' + self.json[1:]
+
+    def msgpack_seq(self, seq: int) -> bytes:
+        # the event is always a fixmap, so one more entry is one more in the header
+        return (
+            bytes((self.msgpack[0] + 1,)) + SEQ_MSGPACK + pack(seq) + self.msgpack[1:]
+        )
+
+
+class RIPRAPGateway:
+    def __init__(self, backplane: Optional[Backplane] = None, debounce: float = 5):
+        # set up as {"snowflake:connection": WebSocketClient}
+        self.connections: dict[str, Any] = {}
+        # set up as {"user snowflake": {WebSocketClient, ...}}
+        self.users: dict[str, set] = {}
+        # set up as {"server snowflake": {"online user snowflake", ...}}
+        self.servers: dict[str, set[str]] = {}
+        # set up as {"online user snowflake": {"server snowflake", ...}}
+        self.memberships: dict[str, set[str]] = {}
+        # other workers publish to "u<user>", "s<server>" and "all", this worker
+        # only listens to the users and servers it holds sockets for
+        self.backplane = backplane or Backplane()
+        self.backplane.subscribe("all")
+        # connections dropped for letting their outbound queue fill up
+        self.evicted = 0
+        # connections dropped for not answering heartbeats
+        self.reaped = 0
+        self.resumed = 0
+        # heartbeats and their timeouts for every connection
+        self.timers = TimerWheel()
+        self.events = 0
+        self.frames = 0
+        self.bytes = 0
+        # presence, set up as {"user snowflake": "online" | "idle"} for users
+        # connected here, and as
+        # {"server snowflake": {"user snowflake": {"worker": status}}} for what
+        # the other workers have for the members of servers held here
+        self.statuses: dict[str, str] = {}
+        self.remote: dict[str, dict[str, dict[str, str]]] = {}
+        # set up as {"server snowflake": {"user snowflake": status}}, the last
+        # status announced here, changes only go out once they held for debounce
+        # seconds so a flapping connection sends nothing
+        self.announced: dict[str, dict[str, str]] = {}
+        self.debounce = debounce
+        # set up as {"user snowflake": (Timer, {"server snowflake", ...})}
+        self.pending: dict[str, tuple[Timer, set[str]]] = {}
+
+    async def start(self):
+        self.timers.start()
+        await self.backplane.start(self.receive)
+
+    async def stop(self):
+        self.timers.stop()
+        await self.backplane.stop()
+
+    def online(self, user: str) -> bool:
+        return str(user) in self.users
+
+    def add(self, client, servers: Iterable[str] = ()):
+        self.connections[client.identifier] = client
+        if client.user not in self.users:
+            self.users[client.user] = set()
+            self.backplane.subscribe(f"u{client.user}")
+        self.users[client.user].add(client)
+        if client.user not in self.memberships:
+            self.memberships[client.user] = set()
+            for server in servers:
+                self._join(str(server), client.user)
+        self.presence(client.user)
+
+    def detach(self, client, timeout: float):
+        # the socket is gone but the session stays registered, so events keep
+        # landing in its replay buffer until it is resumed or expires
+        client.expiry = asyncio.get_running_loop().call_later(
+            timeout, self.remove, client
+        )
+        self.presence(client.user)
+
+    def resume(self, old, client):
+        if old.expiry is not None:
+            old.expiry.cancel()
+        self.connections[client.identifier] = client
+        clients = self.users[client.user]
+        clients.discard(old)
+        clients.add(client)
+        self.resumed += 1
+        self.presence(client.user)
+
+    def remove(self, client):
+        if client.expiry is not None:
+            client.expiry.cancel()
+        if self.connections.get(client.identifier) is client:
+            self.connections.pop(client.identifier)
+        clients = self.users.get(client.user)
+        if clients is not None:
+            clients.discard(client)
+            self.presence(client.user)
+            if len(clients) == 0:
+                self.users.pop(client.user)
+                self.backplane.unsubscribe(f"u{client.user}")
+                for server in self.memberships.pop(client.user, ()):
+                    self._forget(server, client.user)
+
+    def presence(self, user: str):
+        # online if any live socket is active, idle if they are all idle or
+        # waiting to be resumed, offline once the last one is gone
+        clients = self.users.get(user, ())
+        if len(clients) == 0:
+            status = OFFLINE
+        elif any(not x.error and not x.idle for x in clients):
+            status = ONLINE
+        else:
+            status = IDLE
+        if status == self.statuses.get(user, OFFLINE):
+            return
+        if status == OFFLINE:
+            self.statuses.pop(user)
+        else:
+            self.statuses[user] = status
+        servers = self.memberships.get(user, ())
+        for server in servers:
+            self._publish_presence(server, user, status)
+        # remembered now, the memberships are gone by the time offline goes out
+        self._pend(user, servers)
+
+    def present(self, server: str) -> dict[str, str]:
+        # O(online members), the local online set plus what other workers have
+        server = str(server)
+        statuses = {}
+        for user in set(self.servers.get(server, ())).union(
+            self.remote.get(server, ())
+        ):
+            status = self._status(server, user)
+            if status != OFFLINE:
+                statuses[user] = status
+        return statuses
+
+    def join(self, server: str, user: str):
+        server, user = str(server), str(user)
+        self._join(server, user)
+        self.backplane.publish(f"u{user}", f"j {server}")
+
+    def leave(self, server: str, user: str):
+        server, user = str(server), str(user)
+        self._leave(server, user)
+        self.backplane.publish(f"u{user}", f"l {server}")
+
+    def drop_server(self, server: str):
+        server = str(server)
+        self._drop_server(server)
+        self.backplane.publish(f"s{server}", "d")
+
+    def revoke(self, user: str, token: Optional[str] = None):
+        # a logged out session (or every session of a deleted account) loses its
+        # sockets right away, on every worker
+        user = str(user)
+        self._revoke(user, token)
+        self.backplane.publish(f"u{user}", "r " + (token or ""))
+
+    def send(self, users: Iterable[str], data: "dict | Event"):
+        event = Event.of(data)
+        for user in users:
+            user = str(user)
+            self._send(user, event)
+            if self.backplane.remote:
+                self.backplane.publish(f"u{user}", "e " + event.wire())
+
+    def send_to_server(
+        self, server: str, data: "dict | Event", channel: Optional[str] = None
+    ):
+        event = Event.of(data)
+        server = str(server)
+        event.server = server
+        event.channel = None if channel is None else str(channel)
+        for user in self.servers.get(server, ()):
+            self._send(user, event)
+        if self.backplane.remote:
+            self.backplane.publish(f"s{server}", "e " + event.wire())
+
+    def broadcast(self, data: "dict | Event"):
+        event = Event.of(data)
+        for client in self.connections.values():
+            if client.wants(event):
+                client.send(event)
+        if self.backplane.remote:
+            self.backplane.publish("all", "e " + event.wire())
+
+    def receive(self, topic: str, payload: str):
+        # something another worker published, only deliver it locally
+        kind, _, body = payload.partition(" ")
+        target = topic[1:]
+        match topic[0], kind:
+            case "u", "e":
+                self._send(target, Event.unwire(body))
+            case "u", "j":
+                self._join(body, target)
+            case "u", "l":
+                self._leave(body, target)
+            case "u", "r":
+                self._revoke(target, body or None)
+            case "s", "e":
+                event = Event.unwire(body)
+                for user in self.servers.get(target, ()):
+                    self._send(user, event)
+            case "s", "p":
+                self._remote_presence(target, *body.split(" "))
+            case "s", "q":
+                # a worker just started holding this server, tell it who is here
+                for user in self.servers.get(target, ()):
+                    if user in self.statuses:
+                        self._publish_presence(target, user, self.statuses[user])
+            case "s", "d":
+                self._drop_server(target)
+            case "a", "e":
+                event = Event.unwire(body)
+                for client in self.connections.values():
+                    if client.wants(event):
+                        client.send(event)
+
+    def _send(self, user: str, event: Event):
+        # filtered before anything is sequenced or enqueued
+        for client in self.users.get(user, ()):
+            if client.wants(event):
+                client.send(event)
+
+    def _status(self, server: str, user: str) -> str:
+        statuses = list(self.remote.get(server, {}).get(user, {}).values())
+        if user in self.servers.get(server, ()):
+            statuses.append(self.statuses.get(user, IDLE))
+        return max(statuses, key=RANK.get, default=OFFLINE)
+
+    def _pend(self, user: str, servers: Iterable[str]):
+        if user not in self.pending:
+            self.pending[user] = (
+                self.timers.schedule(self.debounce, self._announce, user),
+                set(),
+            )
+        self.pending[user][1].update(servers)
+
+    def _announce(self, user: str):
+        # every worker works the status out from all of them and only tells its
+        # own sockets, so a user on two workers is online while either has them
+        _, servers = self.pending.pop(user)
+        for server in servers:
+            if server not in self.servers:
+                continue
+            status = self._status(server, user)
+            announced = self.announced.setdefault(server, {})
+            if status == announced.get(user, OFFLINE):
+                continue
+            if status == OFFLINE:
+                announced.pop(user)
+            else:
+                announced[user] = status
+            event = Event(204, {"snowflake": user, "status": status})
+            event.server = server
+            for member in self.servers[server]:
+                self._send(member, event)
+
+    def _publish_presence(self, server: str, user: str, status: str):
+        if self.backplane.remote:
+            self.backplane.publish(
+                f"s{server}", f"p {self.backplane.origin} {user} {status}"
+            )
+
+    def _remote_presence(self, server: str, origin: str, user: str, status: str):
+        if server not in self.servers:
+            return
+        users = self.remote.setdefault(server, {})
+        if status == OFFLINE:
+            workers = users.get(user, {})
+            workers.pop(origin, None)
+            if len(workers) == 0:
+                users.pop(user, None)
+        else:
+            users.setdefault(user, {})[origin] = status
+        self._pend(user, (server,))
+
+    def _revoke(self, user: str, token: Optional[str]):
+        for client in list(self.users.get(user, ())):
+            if token is None or client.session.token == token:
+                client.disconnect(4004, "Session revoked")
+                # not resumable, drop it now instead of waiting for it to expire
+                self.remove(client)
+
+    def _join(self, server: str, user: str):
+        if user in self.memberships:
+            self.memberships[user].add(server)
+            if server not in self.servers:
+                self.servers[server] = set()
+                self.backplane.subscribe(f"s{server}")
+                self.backplane.publish(f"s{server}", "q")
+            self.servers[server].add(user)
+            status = self.statuses.get(user, OFFLINE)
+            if status != OFFLINE:
+                self._publish_presence(server, user, status)
+
+    def _leave(self, server: str, user: str):
+        if user in self.memberships:
+            self.memberships[user].discard(server)
+            # they are not in it anymore whatever their sockets are doing
+            self._publish_presence(server, user, OFFLINE)
+            self._pend(user, (server,))
+        self._forget(server, user)
+
+    def _forget(self, server: str, user: str):
+        members = self.servers.get(server)
+        if members is not None:
+            members.discard(user)
+            if len(members) == 0:
+                # nothing more comes in for it, so what is known goes stale
+                self.servers.pop(server)
+                self.remote.pop(server, None)
+                self.announced.pop(server, None)
+                self.backplane.unsubscribe(f"s{server}")
+
+    def _drop_server(self, server: str):
+        self.remote.pop(server, None)
+        self.announced.pop(server, None)
+        for user in self.servers.pop(server, ()):
+            self.memberships[user].discard(server)
+        self.backplane.unsubscribe(f"s{server}")
+
+    def sent(self, events: int, size: int):
+        self.events += events
+        self.frames += 1
+        self.bytes += size
+
+    def stats(self, slowest: int = 10) -> dict:
+        # served without auth, so only aggregates, never identifiers or sessions
+        depths = [x.queue.qsize() for x in self.connections.values()]
+        return {
+            "connections": len(self.connections),
+            "users": len(self.users),
+            "evicted": self.evicted,
+            "reaped": self.reaped,
+            "online": len(self.statuses),
+            "detached": sum(1 for x in self.connections.values() if x.error),
+            "resumed": self.resumed,
+            "sent": {
+                "events": self.events,
+                "frames": self.frames,
+                "bytes": self.bytes,
+                "bytes_per_event": self.bytes / self.events if self.events else 0,
+            },
+            "queue_depth": {
+                "total": sum(depths),
+                "max": max(depths, default=0),
+                "slowest": [x for x in heapq.nlargest(slowest, depths) if x > 0],
+            },
+        }
@@ -0,0 +1,104 @@
+import json
+import logging
+import queue
+import random
+import sys
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional
+
+import config
+
+# the minimum level that gets written, and {"category": fraction} of the records
+# below WARNING to keep, e.g. {"gateway.tx": 0.01}
+LEVEL = getattr(config, "LOG_LEVEL", "INFO")
+SAMPLING: dict[str, float] = getattr(config, "LOG_SAMPLING", {})
+
+_listener: Optional[QueueListener] = None
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": record.created,
+            "level": record.levelname,
+            "category": record.name.removeprefix("riprap."),
+            "message": record.getMessage(),
+        }
+        entry.update(getattr(record, "fields", {}))
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class _QueueHandler(QueueHandler):
+    # the stock prepare formats the whole record on the caller's thread, this
+    # only flattens what can not wait and leaves the json to the writer thread
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+class Logger:
+    """A category logger, records are sampled before anything is built."""
+
+    __slots__ = ("logger", "rate")
+
+    def __init__(self, category: str):
+        self.logger = logging.getLogger(f"riprap.{category}")
+        self.rate = SAMPLING.get(category, 1.0)
+
+    def enabled(self, level: int) -> bool:
+        return self.logger.isEnabledFor(level)
+
+    def log(self, level: int, message: str, exc_info: bool = False, **fields):
+        if not self.logger.isEnabledFor(level):
+            return
+        if level < logging.WARNING and self.rate < 1 and random.random() >= self.rate:
+            return
+        self.logger.log(level, message, exc_info=exc_info, extra={"fields": fields})
+
+    def debug(self, message: str, **fields):
+        self.log(logging.DEBUG, message, **fields)
+
+    def info(self, message: str, **fields):
+        self.log(logging.INFO, message, **fields)
+
+    def warning(self, message: str, **fields):
+        self.log(logging.WARNING, message, **fields)
+
+    def error(self, message: str, **fields):
+        self.log(logging.ERROR, message, **fields)
+
+    def exception(self, message: str, **fields):
+        self.log(logging.ERROR, message, exc_info=True, **fields)
+
+
+def get(category: str) -> Logger:
+    return Logger(category)
+
+
+def start():
+    # records go onto a queue from the event loop, a background thread writes them
+    global _listener
+    if _listener is not None:
+        return
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(JSONFormatter())
+    records = queue.SimpleQueue()
+    root = logging.getLogger("riprap")
+    root.setLevel(LEVEL)
+    root.addHandler(_QueueHandler(records))
+    root.propagate = False
+    _listener = QueueListener(records, handler)
+    _listener.start()
+
+
+def stop():
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
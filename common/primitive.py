@@ -141,7 +141,8 @@ class Server(BaseModel):
     owner: User
     snowflake: str
     channels: Optional[list[Channel]]
-    members: list[User]
+    # members are paged in through member_get
+    member_count: Optional[int]
     invites: list[str]
 
     # @classmethod
@@ -150,7 +151,9 @@ class Server(BaseModel):
 
     @staticmethod
     @sync_cache()
-    def from_prisma(server: models.Server, level: int = 0):
+    def from_prisma(
+        server: models.Server, level: int = 0, member_count: Optional[int] = None
+    ):
         return Server(
             name=server.name,
             picture=b64tostr(server.picture),
@@ -164,10 +167,7 @@ class Server(BaseModel):
             ]
             if level < 2
             else None,
-            members=[
-                User.from_prisma(x.user or raise_inline("NO MEMBERS IN SERVER SET"), 1)
-                for x in server.members or []
-            ],
+            member_count=member_count,
             invites=[x.invite for x in server.invites or []] if level == 0 else [],
         )
 
@@ -212,6 +212,18 @@ class Join(BaseModel):
     invite: str
 
 
+class Ready(BaseModel):
+    user: User
+    servers: list[Server]
+    # set up as {"channel snowflake": [Message, ...]}, newest first
+    messages: dict[str, list[Message]]
+
+
+class Presence(BaseModel):
+    snowflake: str
+    status: str
+
+
 # class Error:
 #     class Invalid:
 #         class Type(Exception):
@@ -265,6 +277,10 @@ class Option:
         limit: Optional[int] = None
         before: Optional[str] = None
 
+    class MembersQuery(BaseModel):
+        limit: Optional[int] = None
+        after: Optional[str] = None
+
     class Password(BaseModel):
         password: str
 
@@ -311,6 +327,10 @@ class List:
     class Channels(BaseModel):
         channels: list[Channel]
 
+    class Presences(BaseModel):
+        online: int
+        presences: list[Presence]
+
 
 class Update:
     class User(BaseModel):
@@ -0,0 +1,95 @@
+import asyncio
+import math
+from typing import Any, Callable, Optional
+
+import common.log
+
+log = common.log.get("timers")
+
+
+class Timer:
+    __slots__ = ("deadline", "callback", "args", "cancelled")
+
+    def __init__(self, deadline: int, callback: Callable, args: tuple):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        # cancelled timers stay in their slot and are skipped when it comes up
+        self.cancelled = True
+
+
+class TimerWheel:
+    """Hierarchical timer wheel, a single task drives every timer in the process.
+
+    A tick only touches the timers that are due and the ones cascading down from
+    a coarser level, so the cost follows expiring timers, not how many exist.
+    """
+
+    def __init__(self, tick: float = 1.0, slots: int = 64, levels: int = 3):
+        self.tick = tick
+        self.slots = slots
+        # wheels[level][slot] is a list of timers, a slot on level n spans
+        # slots ** n ticks
+        self.wheels: list[list[list[Timer]]] = [
+            [[] for _ in range(slots)] for _ in range(levels)
+        ]
+        # ticks since the wheel started
+        self.now = 0
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+
+    def schedule(self, delay: float, callback: Callable, *args: Any) -> Timer:
+        timer = Timer(self.now + max(1, math.ceil(delay / self.tick)), callback, args)
+        self._place(timer)
+        return timer
+
+    def _place(self, timer: Timer):
+        # the lowest level whose next coarser slot already holds both now and
+        # the deadline, so the timer cascades down before it is due
+        for level in range(len(self.wheels)):
+            span = self.slots**level
+            if timer.deadline // (span * self.slots) == self.now // (span * self.slots):
+                break
+        self.wheels[level][(timer.deadline // span) % self.slots].append(timer)
+
+    def _advance(self):
+        self.now += 1
+        for level in range(len(self.wheels) - 1, 0, -1):
+            span = self.slots**level
+            if self.now % span == 0:
+                index = (self.now // span) % self.slots
+                timers, self.wheels[level][index] = self.wheels[level][index], []
+                for timer in timers:
+                    if not timer.cancelled:
+                        self._place(timer)
+        index = self.now % self.slots
+        timers, self.wheels[0][index] = self.wheels[0][index], []
+        for timer in timers:
+            if timer.cancelled:
+                continue
+            if timer.deadline > self.now:
+                # past the top level when it was scheduled, wait for it to come round
+                self._place(timer)
+                continue
+            try:
+                timer.callback(*timer.args)
+            except Exception:
+                log.exception("timer failed", callback=timer.callback.__qualname__)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        while True:
+            await asyncio.sleep(started + (self.now + 1) * self.tick - loop.time())
+            # catch up on ticks missed while the loop was busy
+            while started + (self.now + 1) * self.tick <= loop.time():
+                self._advance()
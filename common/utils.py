@@ -3,8 +3,8 @@ import globals
 import asyncio
 import inspect
 import config
+from contextvars import ContextVar
 from functools import wraps
-from hashlib import sha512
 from pprint import pprint
 from time import time as now
 from typing import Callable, Optional
@@ -14,9 +14,14 @@ from quart_schema import tag
 
 import quart_schema
 
+import common.log
+from common.cache import FLIGHT_TIMEOUT, MISSING, SingleFlight
 import common.primitive as Primitive
 from quart import current_app as app
 
+cachelog = common.log.get("cache")
+benchmarklog = common.log.get("benchmark")
+
 print(Fore.WHITE)
 
 
@@ -97,184 +102,176 @@ def ratelimit(time: int, quantity: int = 1):
     return decorator
 
 
+# Cache.version when the coalesced read running in this context started, so
+# sync_cache does not keep a value built from rows a write has overtaken
+_reading: ContextVar[Optional[int]] = ContextVar("reading", default=None)
+
+# arguments that key by their type and value, 1, 1.0 and True are equal and hash
+# alike so the value alone would share one entry, strings key as themselves and
+# anything else keys by its type and identity
+_PLAIN = (int, float, bool, type(None))
+# between the positional and keyword arguments, so (a, "level", 1) is not (a, level=1)
+_KWARGS = object()
+
+
+def _key(arg):
+    if isinstance(arg, str):
+        return arg
+    if isinstance(arg, _PLAIN):
+        return (type(arg), arg)
+    snowflake = getattr(arg, "snowflake", None)
+    if snowflake is not None:
+        return (type(arg), snowflake)
+    token = getattr(arg, "token", None)
+    if token is not None:
+        return (type(arg), token)
+    if isinstance(arg, tuple):
+        return tuple(_key(x) for x in arg)
+    return (type(arg), repr(arg))
+
+
+def cache_key(args: tuple, kwargs: dict) -> tuple:
+    # positional order is kept, so (a, 1) and (1, a) are different keys
+    key = [_key(x) for x in args]
+    if kwargs:
+        key.append(_KWARGS)
+        for name in sorted(kwargs):
+            key.append(name)
+            key.append(_key(kwargs[name]))
+    return tuple(key)
+
+
 def async_cache(time: int = 300):
     def decorator(func: Callable):
         @wraps(func)
         async def wrapper(*args, **kwargs):
-            before = now()
-            # pprint(app.cache)
-            nocache = False
-            if kwargs.get("nocache") is not None:
-                nocache = kwargs.pop("nocache")
-            if not nocache:
-                cachehash = "async"
-                for arg in args:
-                    try:
-                        if "snowflake" in dir(arg):
-                            cachehash = f"{cachehash}{arg.snowflake}"
-                        else:
-                            cachehash = f"{cachehash}{arg}"
-                    except:
-                        print(arg)
-                    # if isinstance(arg, str):
-                    #     cachehash += arg
-                    # elif isinstance(arg, int):
-                    #     cachehash += str(arg)
-                    # elif isinstance(arg, Primitive.Snowflake):
-                    #     cachehash += str(arg.snowflake)
-                cachehash = sha512(cachehash.encode("utf-8")).hexdigest()
-                if app.cache.get(func.__name__) is None:
-                    app.cache[func.__name__] = {}
-                if app.cache[func.__name__].get(cachehash) is None:
-                    app.cache[func.__name__][cachehash] = [
-                        await func(*args, **kwargs),
-                        0,
-                    ]
-                else:
-                    if app.cache[func.__name__][cachehash][1] > now():
-                        asyncio.create_task(
-                            get_updated_async_cache(func, cachehash, time, args, kwargs)
-                        )
-                        if app.loader == "__main__":
-                            stringy = f"CACHED   {(now()) - before:.4f} "
-                            # stringy += " " * (17 - len(stringy))
-                            stringy += "| "
-                            print(Fore.GREEN + stringy, end="\n" + Fore.GREEN)
-                        return app.cache[func.__name__][cachehash][0]
-                    else:
-                        app.cache[func.__name__][cachehash] = [
-                            await func(*args, **kwargs),
-                            now() + time,
-                        ]
-                if app.loader == "__main__":
-                    stringy = f"UNCACHED {(now()) - before:.4f} "
-                    # stringy += " " * (17 - len(stringy))
-                    stringy += "| "
-                    print(Fore.RED + stringy, end="\n" + Fore.RED)
-                return app.cache[func.__name__][cachehash][0]
-            else:
+            nocache = kwargs.pop("nocache", None) or False
+            if nocache:
                 return await func(*args, **kwargs)
+            key = cache_key(args, kwargs)
+            cache = app.cache.namespace(func.__qualname__)
+            value = cache.get(
+                key,
+                refresh=lambda: asyncio.create_task(
+                    get_updated_async_cache(func, key, time, args, kwargs)
+                ),
+            )
+            if value is not MISSING:
+                cachelog.debug("hit", function=func.__qualname__)
+                return value
+            before = now()
+            value = await fly(
+                cache.flights, key, load_async_cache, func, key, time, args, kwargs
+            )
+            cachelog.debug("miss", function=func.__qualname__, seconds=now() - before)
+            return value
 
         return wrapper
 
     return decorator
 
 
+def coalesce(timeout: float = FLIGHT_TIMEOUT):
+    # for RIPRAPDatabase reads, identical calls running at the same time share
+    # one query, nothing is kept afterwards
+    def decorator(func: Callable):
+        flights = SingleFlight(timeout)
+
+        @wraps(func)
+        async def wrapper(self, *args, **kwargs):
+            # a read that started before a write is not shared with later callers
+            version = self.cache.version if self.cache is not None else 0
+            key = (version, cache_key(args, kwargs))
+            # the run copies this context when it starts, so it sees the version
+            # even when it is shared
+            token = _reading.set(None if self.cache is None else version)
+            try:
+                return await fly(flights, key, func, self, *args, **kwargs)
+            finally:
+                _reading.reset(token)
+
+        wrapper.flights = flights
+        return wrapper
+
+    return decorator
+
+
+async def fly(flights: SingleFlight, key, func: Callable, *args, **kwargs):
+    try:
+        return await flights.do(key, func, *args, **kwargs)
+    except asyncio.TimeoutError:
+        raise Primitive.Error("Timed out waiting for another request", 504)
+
+
 def sync_cache(time: int = 300):
     def decorator(func: Callable):
         @wraps(func)
         def wrapper(*args, **kwargs):
+            nocache = kwargs.pop("nocache", None) or False
+            key = cache_key(args, kwargs)
+            cache = app.cache.namespace(func.__qualname__)
+            if not nocache:
+                value = cache.get(
+                    key,
+                    refresh=lambda: asyncio.create_task(
+                        get_updated_sync_cache(
+                            func, key, time, args, kwargs, cache.version
+                        )
+                    ),
+                )
+                if value is not MISSING:
+                    cachelog.debug("hit", function=func.__qualname__)
+                    return value
             before = now()
-            # pprint(app.cache)
-            nocache = False
-            if kwargs.get("nocache") is not None:
-                nocache = kwargs.pop("nocache")
-            # if not nocache:
-            cachehash = "sync"
-            arglist = []
-            for arg in args:
-                arglist.append(arg)
-            for arg in kwargs:
-                arglist.append(kwargs[arg])
-            newarglist = []
-            for arg in arglist:
-                newarg = ""
-                try:
-                    newarg = str(arg.snowflake)
-                except:
-                    try:
-                        newarg = str(arg.token)
-                    except:
-                        # print(arg)
-                        newarg = str(arg)
-                newarglist.append(newarg)
-            newarglist.sort()
-            # for arg in arglist:
-            #     try:
-            #         # if "snowflake" in dir(arg):
-            #         #     cachehash = f"{cachehash}{arg.snowflake}"
-            #         # elif "user" in dir(arg):
-            #         #     cachehash = f"{cachehash}{arg.user.snowflake}"
-            #         # elif "server" in dir(arg):
-            #         #     cachehash = f"{cachehash}{arg.server.snowflake}"
-            #         # else:
-            #         # add = str(arg)
-            #         # try:
-            #         #     add = arg.snowflake
-            #         # except:
-            #         #     try:
-            #         #         add = arg.token
-            #         #     except:
-            #         #         print("WHY")
-            #         # print("                                 " + add)
-            #         cachehash = f"{cachehash}{add}"
-            #     except Exception as e:
-            #         print(e)
-            #         print(arg)
-            # if isinstance(arg, str):
-            #     cachehash += arg
-            # elif isinstance(arg, int):
-            #     cachehash += str(arg)
-            # elif isinstance(arg, Primitive.Snowflake):
-            #     cachehash += str(arg.snowflake)
-            cachehash = "sync" + "".join(newarglist)
-            # print(cachehash)
-            # print(f"{func.__name__}: {cachehash}")
-            cachehash = sha512(cachehash.encode("utf-8")).hexdigest()
-
-            if app.cache.get(func.__name__) is None:
-                app.cache[func.__name__] = {}
-            if app.cache[func.__name__].get(cachehash) is None:
-                app.cache[func.__name__][cachehash] = [
-                    func(*args, **kwargs),
-                    0,
-                ]
-            else:
-                if app.cache[func.__name__][cachehash][1] > now() and not nocache:
-                    asyncio.create_task(
-                        get_updated_sync_cache(func, cachehash, time, args, kwargs)
-                    )
-                    if app.loader == "__main__":
-                        stringy = f"CACHED   {(now()) - before:.4f} "
-                        # stringy += " " * (17 - len(stringy))
-                        stringy += "| "
-                        print(Fore.GREEN + stringy, end="\n" + Fore.GREEN)
-                    return app.cache[func.__name__][cachehash][0]
-                else:
-                    app.cache[func.__name__][cachehash] = [
-                        func(*args, **kwargs),
-                        now() + time,
-                    ]
-            if app.loader == "__main__":
-                stringy = f"UNCACHED {(now()) - before:.4f} "
-                # stringy += " " * (17 - len(stringy))
-                stringy += "| "
-                print(Fore.RED + stringy, end="\n" + Fore.RED)
-            return app.cache[func.__name__][cachehash][0]
+            value = func(*args, **kwargs)
+            # a write that landed while the rows were being read already
+            # invalidated, caching them now would bring the old value back
+            started = _reading.get()
+            if started is None or started == app.cache.version:
+                cache.put(key, value, time)
+            cachelog.debug("miss", function=func.__qualname__, seconds=now() - before)
+            return value
 
         return wrapper
 
     return decorator
 
 
-async def get_updated_async_cache(func, cachehash, time, args, kwargs):
-    if app.cache.get(func.__name__) is None:
-        app.cache[func.__name__] = {}
-    app.cache[func.__name__][cachehash] = [await func(*args, **kwargs), now() + time]
+async def load_async_cache(func, key, time, args, kwargs):
+    cache = app.cache.namespace(func.__qualname__)
+    # dropped if a write invalidated anything while it loaded
+    version = cache.version
+    value = await func(*args, **kwargs)
+    cache.put(key, value, time, version)
+    return value
 
 
-async def get_updated_sync_cache(func, cachehash, time, args, kwargs):
-    if app.cache.get(func.__name__) is None:
-        app.cache[func.__name__] = {}
-    app.cache[func.__name__][cachehash] = [func(*args, **kwargs), now() + time]
+async def get_updated_async_cache(func, key, time, args, kwargs):
+    # a miss already loading this key covers the refresh too
+    try:
+        await app.cache.namespace(func.__qualname__).flights.do(
+            key, load_async_cache, func, key, time, args, kwargs
+        )
+    except Exception:
+        # the old value is served until it expires, then the next miss retries
+        cachelog.exception("refresh failed", function=func.__qualname__)
+
+
+async def get_updated_sync_cache(func, key, time, args, kwargs, version):
+    try:
+        app.cache.namespace(func.__qualname__).put(
+            key, func(*args, **kwargs), time, version
+        )
+    except Exception:
+        cachelog.exception("refresh failed", function=func.__qualname__)
 
 
 async def send_to_websocket(users: list[str], data: dict):
-    for member in users:
-        for ws in app.ws.keys():
-            if member == ws.split(":")[0]:
-                # print("Sending message to ", ws)
-                app.ws[ws].append(data)
+    app.ws.send(users, data)
+
+
+async def send_to_server(server: str, data: dict, channel: Optional[str] = None):
+    app.ws.send_to_server(server, data, channel)
 
 
 def benchmark():
@@ -285,17 +282,7 @@ def benchmark():
             result = func(*args, **kwargs)
             if inspect.iscoroutine(result):
                 result = await result
-            if app.loader == "benchmark":
-                name = f"{func.__name__}: ".replace("_", " ").title()
-                name += " " * (20 - len(name))
-                print(
-                    Fore.CYAN
-                    + name
-                    + Fore.MAGENTA
-                    + f"{(now()) - before:.4f} "
-                    + Fore.BLACK,
-                    end="",
-                )
+            benchmarklog.debug("timing", function=func.__name__, seconds=now() - before)
             return result
 
         return wrapper
@@ -305,23 +292,19 @@ def benchmark():
 
 def websocket(code: int, data: dict = {}, sendto: Optional[str] = None):
     def decorator(func: Callable):
+        # called by the gateway as handler(session, **data), errors raised here
+        # are sent back to the caller as a -1 with the request id
         @wraps(func)
-        async def wrapper(*args, **kwargs):
-            if len(args) > 0:
-                return {"code": -1, "data": {"Error": "Invalid arguments"}}
+        async def wrapper(session, **kwargs):
             for arg in kwargs.keys():
                 if arg not in data:
-                    return {"code": -1, "data": {"Error": "Invalid argument " + arg}}
-            try:
-                result = func(*args, **kwargs)
-                if inspect.iscoroutine(result):
-                    result = await result
-            except Exception as e:
-                return {"code": -1, "data": {"Error": str(e)}}
+                    raise Primitive.Error("Invalid argument " + arg, 400)
+            result = func(session, **kwargs)
+            if inspect.iscoroutine(result):
+                result = await result
             if sendto is not None:
                 if sendto == "all":
-                    for token in app.ws.keys():
-                        await app.ws[token].append({"code": code, "data": result})
+                    app.ws.broadcast({"code": code, "data": result})
                 # elif sendto == "servermembers":
                 #     for token in app.ws.keys():
                 #         thisuser = await app.db.user_get(
@@ -337,7 +320,7 @@ def websocket(code: int, data: dict = {}, sendto: Optional[str] = None):
                 #                         {"code": code, "data": result}
                 #                     )
 
-            return {"code": code, "data": result}
+            return result
 
         globals.websocket_handlers[code] = wrapper
         return func
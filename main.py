@@ -1,7 +1,9 @@
-import datetime
+import json
 import sys
 import time
-from typing import Any, Optional, TypedDict
+import zlib
+from collections import deque
+from typing import Any, Coroutine, Optional, TypedDict
 import asyncpg
 from colorama import Fore
 import prisma
@@ -22,11 +24,24 @@ import common.primitive as Primitive
 
 import config
 
-from common.db import RIPRAPDatabase
-
-import bp.auth, bp.server, bp.channel, bp.user, bp.message
+from common.db import MEMBER_PAGE, RIPRAPDatabase
+from common.encoding import (
+    RIPRAPJSONProvider,
+    RIPRAPRequest,
+    pack_array_header,
+    unpack,
+)
+from common.cache import Cache
+from common.gateway import Event, RIPRAPGateway
+from common.timers import Timer
+import common.log
+import common.backplane
 
+# before the blueprints, their websocket handlers register on import
 globals.initialize()
+common.log.start()
+
+import bp.auth, bp.server, bp.channel, bp.user, bp.message
 
 app = Quart(__name__)
 # app.debug = True
@@ -36,6 +51,9 @@ QuartSchema(
     openapi_path="/api/openapi.json",
     redoc_ui_path="/api/redocs",
 )
+# json by default, msgpack for clients that send or accept application/msgpack
+app.json = RIPRAPJSONProvider(app, False)
+app.request_class = RIPRAPRequest
 app.config.update(
     {
         "DATABASE_URL": config.DATABASE_URL,
@@ -65,14 +83,6 @@ def register_blueprints(app: Quart):
 register_blueprints(app)
 
 
-# def encode_json(thing) -> bytes:
-#     return zlib.compress(bytes(json.dumps(thing), "utf-8"))
-
-
-# def decode_json(nibble: bytes):
-#     return json.loads(zlib.decompress(nibble).decode("utf-8"))
-
-
 # @app.route("/")
 # async def index():
 #     count_users = await app.db.fetch_val("SELECT COUNT(*) FROM users")
@@ -81,11 +91,14 @@ register_blueprints(app)
 
 @app.before_serving
 async def startup() -> None:
-    app.db = RIPRAPDatabase(config.DATABASE_URL)
+    app.cache = Cache()
+    app.db = RIPRAPDatabase(config.DATABASE_URL, app.cache)
     await app.db._connect()
-    # set up as {"snowflake": [ list of websockets ]}
-    app.ws = {}
-    app.cache = {}
+    app.ws = RIPRAPGateway(
+        common.backplane.from_config(), getattr(config, "PRESENCE_DEBOUNCE", 5)
+    )
+    app.cache.attach(app.ws.backplane)
+    await app.ws.start()
     app.loader = __loader__.name
     # app.loader = "benchmark"
     # app.websocket_handlers = utils.websocket_handlers
@@ -96,13 +109,24 @@ async def startup() -> None:
 
 @app.after_serving
 async def shutdown() -> None:
-    pass
+    await app.ws.stop()
+    common.log.stop()
 
 
 class WebSocket:
     Response = TypedDict("websocket_tx", {"code": int, "data": Optional[dict]})
 
 
+@app.route("/api/gateway", strict_slashes=False)
+async def gateway_info():
+    return app.ws.stats()
+
+
+@app.route("/api/cache", strict_slashes=False)
+async def cache_info():
+    return app.cache.stats()
+
+
 @app.errorhandler(Primitive.Error)
 async def handle_notexist_session(error: Primitive.Error):
     return {"error": error.args[0]}, error.args[1]
@@ -163,21 +187,72 @@ async def handle_connection_aborted(error: ConnectionAbortedError):
 #         print(data)
 #         await websocket.send(data)
 
-eventspersecond = 10
+txlog = common.log.get("gateway.tx")
+rxlog = common.log.get("gateway.rx")
+gatewaylog = common.log.get("gateway")
+
 heartbeattime = 30
+# how many undelivered events a connection may hold before it gets dropped
+highwater = getattr(config, "WEBSOCKET_HIGH_WATER", 1000)
+# how long a batching client's TX waits to coalesce events into one frame
+batchwindow = getattr(config, "WEBSOCKET_BATCH_WINDOW", 0.005)
+# how many dispatched events a session keeps for replay, and for how long a
+# dropped session can still be resumed, never less than highwater so a client
+# dropped for falling behind still has everything it missed
+resumebuffer = max(getattr(config, "WEBSOCKET_RESUME_BUFFER", highwater), highwater)
+resumetimeout = getattr(config, "WEBSOCKET_RESUME_TIMEOUT", 60)
+# the most messages per channel a client may ask for in READY
+readymessages = getattr(config, "READY_MAX_MESSAGES", 50)
+# how many members go in each chunk of a gateway member list, a chunk is one
+# member_get page so a short one means the list is done
+memberchunk = min(getattr(config, "WEBSOCKET_MEMBER_CHUNK", 1000), MEMBER_PAGE)
+# how many handler calls one connection may have running at once
+maxinflight = getattr(config, "WEBSOCKET_MAX_INFLIGHT", 16)
 
 # websocket docs
 # 0 is auth code
 # -1 is error
-# 1 is heartbeat
+# 1 is heartbeat, acked with {"idle": bool} to mark the client idle or active
+# 2 is identify, {"token": str, "batch": bool, "compress": "zlib-stream",
+#                 "encoding": "json" | "msgpack"}
+#   batch clients get every frame as an array of {"code", "data"} objects
+#   msgpack clients get binary msgpack frames with snowflakes as 64 bit ints,
+#   binary frames sent to the gateway are always decoded as msgpack
+#   zlib-stream clients get binary frames from one zlib stream per connection,
+#   each frame ends on a sync flush (00 00 ff ff) so it can be inflated on arrival
+#   "intents": {"servers": [str], "channels": [str], "events": [int]} limits
+#   which dispatches the connection gets, a missing or null key means all of them
+#   "messages": int asks for that many of the newest messages per channel
+#   replied to with READY, {"session_id": str, "seq": int, "user": User,
+#   "servers": [Server], "messages": {"channel snowflake": [Message]}}
+# 3 is resume, {"token": str, "session_id": str, "seq": int}
+#   seq is the last one the client saw, everything after it is sent again and
+#   then answered with {"session_id": str, "seq": int}, if the session expired
+#   or missed too much the reply is -1 and the client should identify again
+# 4 is update intents, same shape as in identify, only the keys sent change,
+#   replied to with the intents now in effect
+# 5 is request members, {"server": str}, answered with one frame per chunk of
+#   {"server": str, "chunk": int, "done": bool, "members": [User]} until done
+# every event from 100 up carries a "seq" that counts up per session
+# any other code is a call to a registered handler, {"code", "data", "id"}
+#   calls run concurrently and may be answered out of order, the reply (or a -1
+#   error) carries the same "id" so the client can match it up
 # 1xx is creation events
 # 100 is message create
 # 2xx is updat events
 # 200 is be message update
 # 201 is user update
+# 204 is presence update, {"snowflake": str, "status": "online" | "idle" | "offline"}
+#   only sent once a change has held for PRESENCE_DEBOUNCE seconds
 # 3xx is deletion events
 # 300 is message delete
 
+# close codes
+# 4004 is session revoked, the token was logged out or the account deleted
+# 4007 is session resumed elsewhere, another connection took the session over
+# 4008 is slow consumer, the client fell too far behind and may resume
+# 4009 is heartbeat timeout, two heartbeats in a row went unanswered
+
 # x00 is message
 # x01 is user
 # x02 is server
@@ -187,53 +262,321 @@ heartbeattime = 30
 class WebSocketClient:
     def __init__(self):
         self.hbcount = 0
-        self.lasthb = None
-        self.missed = 0
+        # the next heartbeat, and the deadline for acking the oldest unacked one
+        self.heartbeat: Optional[Timer] = None
+        self.timeout: Optional[Timer] = None
         self.error = False
+        # set by the client in its heartbeat acks, feeds presence
+        self.idle = False
         self.identifier = None
+        self.user = None
+        # the session this socket identified with, handlers are authed by it
+        self.session: Optional[Primitive.Session] = None
+        self.closecode = None
+        self.batch = False
+        self.deflate = None
+        self.encoding = "json"
+        # intents, the servers, channels and event codes this connection wants
+        # dispatched, None is everything
+        self.servers: Optional[set[str]] = None
+        self.channels: Optional[set[str]] = None
+        self.events: Optional[set[int]] = None
+        self.seq = 0
+        # (seq, event) for the last dispatched events, kept after disconnect
+        self.replay: deque[tuple[int, Event]] = deque(maxlen=resumebuffer)
+        self.expiry: Optional[asyncio.TimerHandle] = None
+        # handler calls that have not replied yet
+        self.inflight: set[asyncio.Task] = set()
+        # outbound events, TX sleeps on this until something is enqueued, a
+        # resume puts its whole backlog in as one list so it is not bounded
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=highwater)
+
+    def wants(self, event: Event) -> bool:
+        if event.code < 100:
+            return True
+        return (
+            (self.events is None or event.code in self.events)
+            and (
+                self.servers is None
+                or event.server is None
+                or event.server in self.servers
+            )
+            and (
+                self.channels is None
+                or event.channel is None
+                or event.channel in self.channels
+            )
+        )
+
+    def intents(self, thisdata: Any) -> dict:
+        # only the keys that are present change, null goes back to everything,
+        # all of them are checked before any changes
+        if not isinstance(thisdata, dict):
+            raise Primitive.Error("Invalid intents", 400)
+        changes = {}
+        for key, kind in (("servers", str), ("channels", str), ("events", int)):
+            if key not in thisdata:
+                continue
+            values = thisdata[key]
+            if values is None:
+                changes[key] = None
+                continue
+            if not isinstance(values, list):
+                raise Primitive.Error(f"Invalid {key} intent", 400)
+            try:
+                changes[key] = {kind(x) for x in values}
+            except (TypeError, ValueError, OverflowError):
+                raise Primitive.Error(f"Invalid {key} intent", 400)
+        for key, value in changes.items():
+            setattr(self, key, value)
+        return {
+            "servers": None if self.servers is None else list(self.servers),
+            "channels": None if self.channels is None else list(self.channels),
+            "events": None if self.events is None else list(self.events),
+        }
+
+    def send(self, event: Event):
+        seq = None
+        if event.code >= 100:
+            self.seq += 1
+            seq = self.seq
+            self.replay.append((seq, event))
+        if not self.error:
+            self.enqueue((seq, event))
+
+    def enqueue(self, item: tuple[Optional[int], Event]):
+        try:
+            self.queue.put_nowait(item)
+        except asyncio.QueueFull:
+            app.ws.evicted += 1
+            self.disconnect(4008, "Slow consumer")
+
+    def close(self):
+        if self.error:
+            return
+        self.error = True
+        for task in self.inflight:
+            task.cancel()
+        if self.heartbeat is not None:
+            self.heartbeat.cancel()
+        if self.timeout is not None:
+            self.timeout.cancel()
+        if self.identifier is not None:
+            app.ws.detach(self, resumetimeout)
+
+    def disconnect(self, code: int, reason: str):
+        # can be called from outside the websocket context, TX does the closing
+        self.closecode = (code, reason)
+        self.close()
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        self.queue.put_nowait(None)
+
+    def frame(self, events: list[tuple[Optional[int], Event]]) -> str | bytes:
+        if self.encoding == "msgpack":
+            encoded = [
+                event.msgpack if seq is None else event.msgpack_seq(seq)
+                for seq, event in events
+            ]
+            if self.batch:
+                frame = pack_array_header(len(encoded)) + b"".join(encoded)
+            else:
+                frame = encoded[0]
+        else:
+            encoded = [
+                event.json if seq is None else event.json_seq(seq)
+                for seq, event in events
+            ]
+            if self.batch:
+                frame = "[" + ",".join(encoded) + "]"
+            else:
+                frame = encoded[0]
+        if self.deflate is not None:
+            if isinstance(frame, str):
+                frame = frame.encode("utf-8")
+            return self.deflate.compress(frame) + self.deflate.flush(zlib.Z_SYNC_FLUSH)
+        return frame
+
+    def resume(
+        self, session: Optional[Primitive.Session], session_id: str, seq: Any
+    ) -> bool:
+        old: Optional[WebSocketClient] = app.ws.connections.get(session_id, None)
+        if (
+            session is None
+            or old is None
+            or old is self
+            or old.session.token != session.token
+            or not isinstance(seq, int)
+            or not 0 <= seq <= old.seq
+            # some of what the client missed has already fallen out of the buffer
+            or old.seq - seq > len(old.replay)
+        ):
+            return False
+        if not old.error:
+            # the old socket has not noticed it is dead yet
+            old.disconnect(4007, "Session resumed elsewhere")
+        if self.identifier is not None:
+            app.ws.remove(self)
+        self.identifier = old.identifier
+        self.user = old.user
+        self.session = session
+        self.batch = old.batch
+        self.encoding = old.encoding
+        self.servers = old.servers
+        self.channels = old.channels
+        self.events = old.events
+        if old.deflate is not None:
+            self.deflate = zlib.compressobj()
+        self.seq = old.seq
+        self.replay = old.replay
+        app.ws.resume(old, self)
+        backlog = [x for x in self.replay if x[0] > seq]
+        if len(backlog) > 0:
+            self.queue.put_nowait(backlog)
+        self.send(Event(3, {"session_id": self.identifier, "seq": self.seq}))
+        return True
 
     async def TX(self):
-        i = 0
-        while not self.error:
-            await asyncio.sleep(1.0 / eventspersecond)
-            i = (i + 1) % (eventspersecond * heartbeattime)
+        while not self.error or self.closecode is not None:
+            events: list[tuple[Optional[int], Event]] = []
+            self.take(events, await self.queue.get())
+            if self.batch and events[-1] is not None:
+                await asyncio.sleep(batchwindow)
+                while not self.queue.empty():
+                    self.take(events, self.queue.get_nowait())
+            if events[-1] is None:
+                await websocket.close(*self.closecode)
+                return
             try:
-                if i == 1:
-                    if self.lasthb is not None:
-                        self.missed += 1
-                        if self.missed > 1:
-                            raise asyncio.CancelledError
-                    else:
-                        self.missed = 0
-                    print(datetime.datetime.now().strftime(r"%H:%M:%S.%f"), " TX")
-                    await websocket.send_json(
-                        WebSocket.Response({"code": 1, "data": {"hb": self.hbcount}})
+                for chunk in [events] if self.batch else [[x] for x in events]:
+                    frame = self.frame(chunk)
+                    await websocket.send(frame)
+                    app.ws.sent(len(chunk), len(frame))
+                    txlog.debug(
+                        "tx",
+                        identifier=self.identifier,
+                        events=len(chunk),
+                        size=len(frame),
                     )
-                    self.lasthb = self.hbcount
-                    self.hbcount += 1
-
-                if self.identifier is not None:
-                    while len(app.ws[self.identifier]) > 0:
-                        print(datetime.datetime.now().strftime(r"%H:%M:%S.%f"), " TX")
-                        await websocket.send_json(
-                            WebSocket.Response(app.ws[self.identifier].pop(0))
-                        )
-
-            except Exception as e:
-                print(e)
-                if self.identifier is not None:
-                    app.ws.pop(self.identifier)
-                self.error = True
+            except Exception:
+                gatewaylog.exception("tx failed", identifier=self.identifier)
+                self.close()
                 raise
 
+    def take(self, events: list, item: Any):
+        # an item is one event, a resumed backlog of them, or None to close
+        if isinstance(item, list):
+            events.extend(item)
+        else:
+            events.append(item)
+
+    def beat(self):
+        # runs off the gateway timer wheel, not a task per connection
+        self.send(Event(1, {"hb": self.hbcount}))
+        self.hbcount += 1
+        if self.timeout is None:
+            # one heartbeat may go unanswered, the second one is fatal
+            self.timeout = app.ws.timers.schedule(heartbeattime * 2, self.reap)
+        self.heartbeat = app.ws.timers.schedule(heartbeattime, self.beat)
+
+    def reap(self):
+        app.ws.reaped += 1
+        self.disconnect(4009, "Heartbeat timeout")
+
+    def call(self, coroutine: Coroutine, id: Any):
+        if len(self.inflight) >= maxinflight:
+            coroutine.close()
+            self.send(Event(-1, {"Error": "Too many requests in flight"}, id))
+            return
+        # runs alongside RX so a slow call never holds up later frames, replies
+        # carry the id back
+        task = asyncio.create_task(coroutine)
+        self.inflight.add(task)
+        task.add_done_callback(self.inflight.discard)
+
+    async def members(self, server: str, id: Any):
+        # the whole member list in chunks, each one its own frame so nothing
+        # has to hold all of them at once
+        after = None
+        chunk = 0
+        try:
+            while True:
+                members = await app.db.member_get(
+                    server=server,
+                    user=self.session.user,
+                    limit=memberchunk,
+                    after=after,
+                )
+                done = len(members) < memberchunk
+                self.send(
+                    Event(
+                        5,
+                        {
+                            "server": server,
+                            "chunk": chunk,
+                            "done": done,
+                            "members": [x.dict() for x in members],
+                        },
+                        id,
+                    )
+                )
+                if done or self.error:
+                    return
+                after = members[-1].snowflake
+                chunk += 1
+        except Primitive.Error as e:
+            self.send(Event(-1, {"Error": e.args[0]}, id))
+        except Exception:
+            gatewaylog.exception("member list failed", identifier=self.identifier)
+            self.send(Event(-1, {"Error": "Internal error"}, id))
+
+    async def dispatch(self, code: int, thisdata: dict, id: Any):
+        if code in globals.websocket_handlers:
+            try:
+                self.send(
+                    Event(
+                        code,
+                        await globals.websocket_handlers[code](
+                            self.session, **thisdata
+                        ),
+                        id,
+                    )
+                )
+            except Primitive.Error as e:
+                # Primitive.Error carries (message, status), anything else may be
+                # database internals so the client only hears that it failed
+                self.send(Event(-1, {"Error": e.args[0]}, id))
+            except Exception:
+                gatewaylog.exception(
+                    "handler failed", identifier=self.identifier, code=code
+                )
+                self.send(Event(-1, {"Error": "Internal error"}, id))
+        else:
+            self.send(Event(-1, {"Error": "Unknown code " + str(code)}, id))
+
     async def RX(self):
         while not self.error:
             try:
-                data: dict[str, str | dict] = await websocket.receive_json()
-                print(datetime.datetime.now().strftime(r"%H:%M:%S.%f"), " RX")
+                frame = await websocket.receive()
+                data: dict[str, str | dict] = (
+                    unpack(frame) if isinstance(frame, bytes) else json.loads(frame)
+                )
+                rxlog.debug(
+                    "rx",
+                    identifier=self.identifier,
+                    code=data.get("code", None),
+                    size=len(frame),
+                )
                 match data.get("code", None):
                     case 1:
-                        self.lasthb = None
+                        if self.timeout is not None:
+                            self.timeout.cancel()
+                            self.timeout = None
+                        idle = bool((data.get("data", None) or {}).get("idle", False))
+                        if idle != self.idle:
+                            self.idle = idle
+                            if self.identifier is not None:
+                                app.ws.presence(self.user)
                     case 2:
                         thisdata = data.get("data", None)
                         if thisdata is not None:
@@ -242,55 +585,121 @@ class WebSocketClient:
                                     token=thisdata.get("token", None)
                                 )
                                 if session is not None:
+                                    try:
+                                        messages = int(thisdata.get("messages", 0))
+                                    except (TypeError, ValueError, OverflowError):
+                                        self.send(
+                                            Event(-1, {"Error": "Invalid messages"})
+                                        )
+                                        continue
+                                    try:
+                                        self.intents(
+                                            thisdata.get("intents", None) or {}
+                                        )
+                                    except Primitive.Error as e:
+                                        self.send(Event(-1, {"Error": e.args[0]}))
+                                        continue
+                                    if self.identifier is not None:
+                                        app.ws.remove(self)
+                                    self.user = str(session.user.snowflake)
+                                    self.session = session
+                                    self.batch = bool(thisdata.get("batch", False))
+                                    if thisdata.get("compress", None) == "zlib-stream":
+                                        self.deflate = zlib.compressobj()
+                                    if thisdata.get("encoding", None) == "msgpack":
+                                        self.encoding = "msgpack"
+                                    ready = await app.db.ready_get(
+                                        user=session.user,
+                                        messages=min(max(messages, 0), readymessages),
+                                    )
+                                    self.seq = 0
+                                    self.replay = deque(maxlen=resumebuffer)
                                     self.identifier = (
-                                        str(session.user.snowflake)
+                                        self.user
                                         + ":"
                                         + str(next(app.db.snowflake_gen))
                                     )
-                                    app.ws[self.identifier] = []
+                                    app.ws.add(
+                                        self, [x.snowflake for x in ready.servers]
+                                    )
+                                    self.send(
+                                        Event(
+                                            2,
+                                            {
+                                                "session_id": self.identifier,
+                                                "seq": self.seq,
+                                                **ready.dict(),
+                                            },
+                                        )
+                                    )
                                 else:
-                                    print(self.identifier)
+                                    gatewaylog.warning(
+                                        "identify without a session",
+                                        identifier=self.identifier,
+                                    )
+                    case 3:
+                        thisdata = data.get("data", None) or {}
+                        session = None
+                        if thisdata.get("token", None) is not None:
+                            session = await app.db.session_get(
+                                token=thisdata.get("token", None)
+                            )
+                        if not self.resume(
+                            session,
+                            str(thisdata.get("session_id", None)),
+                            thisdata.get("seq", None),
+                        ):
+                            self.send(
+                                Event(-1, {"Error": "Session can not be resumed"})
+                            )
+                    case 4:
+                        try:
+                            intents = self.intents(data.get("data", None) or {})
+                        except Primitive.Error as e:
+                            self.send(Event(-1, {"Error": e.args[0]}))
+                            continue
+                        self.send(Event(4, intents))
+                    case 5:
+                        thisdata = data.get("data", None) or {}
+                        if self.identifier is not None:
+                            self.call(
+                                self.members(
+                                    str(thisdata.get("server", None)),
+                                    data.get("id", None),
+                                ),
+                                data.get("id", None),
+                            )
                     case _:
                         thisdata = data.get("data", None)
                         if thisdata is not None:
                             if self.identifier is not None:
-                                session = app.db.session_get(self.identifier)
-                                if session is not None:
-                                    if data["code"] in globals.websocket_handlers:
-                                        try:
-                                            app.ws[self.identifier].append(
-                                                {
-                                                    "code": data["code"],
-                                                    "data": await globals.websocket_handlers[
-                                                        data["code"]
-                                                    ](
-                                                        session, **thisdata
-                                                    ),
-                                                }
-                                            )
-                                        except Exception as e:
-                                            app.ws[self.identifier].append(
-                                                {"code": -1, "data": {"Error": str(e)}}
-                                            )
-                                else:
-                                    print(self.identifier)
+                                self.call(
+                                    self.dispatch(
+                                        data["code"], thisdata, data.get("id", None)
+                                    ),
+                                    data.get("id", None),
+                                )
 
-            except Exception as e:
-                print(e)
-                if self.identifier is not None:
-                    app.ws.pop(self.identifier)
-                self.error = True
+            except Exception:
+                gatewaylog.exception("rx failed", identifier=self.identifier)
+                self.close()
                 raise
 
 
 @app.websocket("/ws")
 async def ws():
     webthighighs = WebSocketClient()
-    producer = asyncio.create_task(webthighighs.TX())
-    consumer = asyncio.create_task(webthighighs.RX())
-    await asyncio.gather(producer, consumer)
-    producer.set_exception(asyncio.CancelledError)
-    consumer.set_exception(asyncio.CancelledError)
+    tasks = [
+        asyncio.create_task(webthighighs.TX()),
+        asyncio.create_task(webthighighs.RX()),
+    ]
+    webthighighs.beat()
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            task.cancel()
+        webthighighs.close()
     del webthighighs
     # websocket.headers
     # await websocket.send_json(WebSocket.Response({"code": 0}))
@@ -392,7 +801,10 @@ async def test():
     print(Fore.BLUE + "Server set test passed")
     assert server.owner.snowflake == testsetuser.snowflake
     print(Fore.BLUE + "Server owner test passed")
-    assert server.members[0].snowflake == testsetuser.snowflake
+    assert server.member_count == 1
+    assert (await app.db.member_get(server=server.snowflake, user=testsetuser))[
+        0
+    ].snowflake == testsetuser.snowflake
     print(Fore.BLUE + "Server member test passed")
     server = await app.db.server_set(
         snowflake=server.snowflake, name="test2", user=testsetuser